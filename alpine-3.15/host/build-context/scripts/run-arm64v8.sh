@@ -0,0 +1,70 @@
+#!/bin/sh
+# Rendered from shared-build-context/host/scripts/run.sh.jinja
+
+
+export ORIGINAL_PATH="$PATH"
+
+# Split the host's job slots between the compiler archs by weight, so that a
+# host providing many toolchains doesn't accept many times more concurrent
+# compiles than it has CPUs or memory for. Overrides:
+#   DISTCC_TOTAL_JOBS          job slots shared by all compiler archs
+#   DISTCC_MEM_PER_JOB_MB      memory needed per job slot (default 256)
+#   DISTCC_WEIGHT_<ARCH_SLUG>  weight of a compiler arch, e.g. DISTCC_WEIGHT_ARM32V7
+#   DISTCC_JOBS_<ARCH_SLUG>    job slots of a compiler arch, ignoring weights
+#   DISTCC_NICE                niceness of the compile jobs (default 5)
+CPUS=$(nproc)
+MEM_AVAILABLE_KB=$(awk '/^MemAvailable:/ { print $2 }' /proc/meminfo)
+if [ -n "$MEM_AVAILABLE_KB" ]; then
+  MEM_JOBS=$((MEM_AVAILABLE_KB / 1024 / ${DISTCC_MEM_PER_JOB_MB:-256}))
+else
+  MEM_JOBS=$CPUS
+fi
+TOTAL_JOBS=${DISTCC_TOTAL_JOBS:-$((CPUS < MEM_JOBS ? CPUS : MEM_JOBS))}
+if [ "$TOTAL_JOBS" -lt 1 ]; then
+  TOTAL_JOBS=1
+fi
+NICE=${DISTCC_NICE:-5}
+
+WEIGHT_ARM64V8=${DISTCC_WEIGHT_ARM64V8:-1}
+TOTAL_WEIGHT=$((WEIGHT_ARM64V8))
+
+# /var/run/distccd/allocation lists "<compiler arch> <port> <jobs>" per
+# compiler arch. It is copied to /var/run/build-farm/allocations/<service>
+# when that directory is mounted, as the rendered docker-compose.yml does
+# with a volume the client containers mount too.
+ALLOCATION=/var/run/distccd/allocation
+SHARED_ALLOCATIONS=/var/run/build-farm/allocations
+: >"$ALLOCATION"
+
+JOBS_ARM64V8=${DISTCC_JOBS_ARM64V8:-$((TOTAL_JOBS * WEIGHT_ARM64V8 / TOTAL_WEIGHT))}
+if [ "$JOBS_ARM64V8" -lt 1 ]; then
+  JOBS_ARM64V8=1
+fi
+echo "arm64/v8 3808 $JOBS_ARM64V8" >>"$ALLOCATION"
+
+if [ -d "$SHARED_ALLOCATIONS" ]; then
+  cp "$ALLOCATION" "$SHARED_ALLOCATIONS/.host-arm64v8" &&
+    mv "$SHARED_ALLOCATIONS/.host-arm64v8" "$SHARED_ALLOCATIONS/host-arm64v8"
+fi
+echo "distccd job allocation for $TOTAL_JOBS slots ($CPUS CPUs, ${MEM_AVAILABLE_KB:-unknown} kB available):" >&2
+cat "$ALLOCATION" >&2
+
+
+export PATH="${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3808 \
+  --jobs "$JOBS_ARM64V8" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-arm64v8.pid \
+  &
+
+
+wait
\ No newline at end of file
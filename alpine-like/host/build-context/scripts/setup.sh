@@ -29,7 +29,12 @@ for toolchain in *; do
 done
 cd -
 
-# Whitelist all compilers for use by distccd
-apk add --no-cache python3
-update-distcc-symlinks
-apk del --no-cache python3
+# Whitelist all compilers for use by distccd, keeping python3 if it was
+# installed for the metrics exporter
+if apk info -e python3 >/dev/null; then
+  update-distcc-symlinks
+else
+  apk add --no-cache python3
+  update-distcc-symlinks
+  apk del --no-cache python3
+fi
@@ -5,18 +5,37 @@ archs/distros."""
 
 import abc
 import argparse
+import base64
+import codecs
+import collections
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
+import http.client
+import io
+import json
 import os
 import re
 import shlex
 import shutil
+import socket
+import sqlite3
 import sys
+import tarfile
+import threading
 import time
+import urllib.parse
+import urllib.request
+import uuid
 
 import sh
 from jinja2 import (
     Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
     StrictUndefined,
+    pass_context,
 )
 from path import (
     Path,
@@ -29,18 +48,543 @@ from sh import (
 )
 
 PROJECT_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = Path(os.environ.get("BUILD_FARM_CACHE_DIR", PROJECT_DIR / ".cache"))
 
 
 def docker(*args, **kwargs):
     print("+ docker " + " ".join(map(shlex.quote, args)))
+    kwargs.setdefault("_out", sys.stdout)
+    kwargs.setdefault("_err", sys.stderr)
     # pylint: disable-next-line=no-name-in-module
-    return sh.docker(_out=sys.stdout, _err=sys.stderr, *args, **kwargs)
+    return sh.docker(*args, **kwargs)
 
 
 def docker_compose(*args, **kwargs):
     print("+ docker-compose " + " ".join(map(shlex.quote, args)))
+    kwargs.setdefault("_out", sys.stdout)
+    kwargs.setdefault("_err", sys.stderr)
     # pylint: disable-next-line=no-name-in-module
-    return sh.docker_compose(_out=sys.stdout, _err=sys.stderr, *args, **kwargs)
+    return sh.docker_compose(*args, **kwargs)
+
+
+def load_docker_config(config_dir=None):
+    if config_dir is None:
+        config_dir = os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker"))
+    try:
+        with open(os.path.join(config_dir, "config.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def docker_config_keys(registry):
+    return ("https://index.docker.io/v1/", "docker.io") if registry == "docker.io" else (registry,)
+
+
+def docker_config_credentials(config, registry):
+    """(serveraddress, username, password) for registry from the inline auths
+    of a docker config, or None."""
+    keys = docker_config_keys(registry)
+    for key, entry in config.get("auths", {}).items():
+        if (key in keys or urllib.parse.urlparse(key).netloc in keys) and entry.get("auth"):
+            username, _, password = base64.b64decode(entry["auth"]).decode().partition(":")
+            return key, username, password
+    return None
+
+
+class DockerAPIError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def decode_json_stream(response):
+    """Decode the concatenated JSON objects of a streamed Docker API
+    response (e.g. pull and push progress) as they arrive."""
+    decoder = json.JSONDecoder()
+    # A multibyte character may be split across chunks
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    while True:
+        chunk = response.read1(65536)
+        if not chunk:
+            break
+        buf += text_decoder.decode(chunk)
+        while True:
+            buf = buf.lstrip()
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except ValueError:
+                # Incomplete object, wait for more data
+                break
+            buf = buf[end:]
+            yield obj
+    buf += text_decoder.decode(b"", final=True)
+    if buf.strip():
+        raise DockerAPIError(f"Truncated Docker API response: {buf!r}")
+
+
+def split_image(image):
+    # e.g. "localhost:5000/tmp:tag" -> ("localhost:5000/tmp", "tag")
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        return image, "latest"
+    return name, tag
+
+
+def image_registry(image):
+    first, _, rest = image.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        return first
+    return "docker.io"
+
+
+class DockerClient:
+    """Client for the Docker Engine API over its unix socket, with a pool of
+    keep-alive connections, which saves forking the docker CLI per call.
+
+    The docker() CLI wrapper remains the fallback, when DOCKER_HOST isn't a
+    unix socket, the daemon can't be reached, or registry credentials are
+    held by a credential helper."""
+
+    def __init__(self, host=None, config_dir=None):
+        if host is None:
+            host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+        self.socket_path = host[len("unix://") :] if host.startswith("unix://") else None
+        self.config_dir = config_dir
+        self.lock = threading.Lock()
+        self.idle = []
+        self._available = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else UnixHTTPConnection(self.socket_path)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        else:
+            with self.lock:
+                self.idle.append(conn)
+
+    @contextlib.contextmanager
+    def request(self, method, path, params=None, body=None, headers=None):
+        if params:
+            path += "?" + urllib.parse.urlencode({key: value for key, value in params.items() if value is not None})
+        with self.connection() as conn:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # The daemon closed an idle keep-alive connection, retry once
+                conn.close()
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            try:
+                if response.status >= 400:
+                    content = response.read()
+                    try:
+                        message = json.loads(content)["message"]
+                    except (ValueError, KeyError, TypeError):
+                        message = content.decode(errors="replace").strip()
+                    raise DockerAPIError(f"{method} {path}: {response.status} {message}")
+                yield response
+            finally:
+                # Drain the response so the connection can be reused
+                response.read()
+
+    def call(self, method, path, params=None, body=None, headers=None):
+        with self.request(method, path, params=params, body=body, headers=headers) as response:
+            content = response.read()
+        return json.loads(content) if content else None
+
+    def stream(self, method, path, params=None, body=None, headers=None):
+        print(f"+ docker-api {method} {path}")
+        with self.request(method, path, params=params, body=body, headers=headers) as response:
+            for message in decode_json_stream(response):
+                if "error" in message:
+                    raise DockerAPIError(message["error"])
+                if "stream" in message:
+                    sys.stdout.write(message["stream"])
+                elif "status" in message and not message.get("progressDetail"):
+                    # Skip the per-layer byte counts of downloads and uploads
+                    print(": ".join(filter(None, (message.get("id"), message["status"]))))
+                yield message
+
+    def available(self):
+        if self._available is None:
+            self._available = False
+            if self.socket_path is not None and os.path.exists(self.socket_path):
+                try:
+                    with self.request("GET", "/_ping"):
+                        self._available = True
+                except (OSError, http.client.HTTPException, DockerAPIError):
+                    pass
+        return self._available
+
+    def registry_auth(self, image):
+        """The X-Registry-Auth header value for image's registry, or None if
+        the credentials are only available through a credential helper."""
+        config = load_docker_config(self.config_dir)
+        registry = image_registry(image)
+        credentials = docker_config_credentials(config, registry)
+        if credentials is not None:
+            serveraddress, username, password = credentials
+            auth = dict(username=username, password=password, serveraddress=serveraddress)
+            return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+        helpers = config.get("credHelpers", {})
+        if config.get("credsStore") or any(key in helpers for key in docker_config_keys(registry)):
+            return None
+        # Anonymous
+        return base64.urlsafe_b64encode(b"{}").decode()
+
+    def image_repo_tags(self):
+        return [tag for image in self.call("GET", "/images/json") for tag in image.get("RepoTags") or ()]
+
+    def inspect_image(self, image):
+        return self.call("GET", f"/images/{urllib.parse.quote(image)}/json")
+
+    def container_ids(self, name):
+        containers = self.call("GET", "/containers/json", params=dict(filters=json.dumps(dict(name=[name]))))
+        return [container["Id"] for container in containers]
+
+    def kill(self, id):
+        self.call("POST", f"/containers/{id}/kill")
+
+    def pull(self, image, platform=None):
+        name, tag = split_image(image)
+        for _ in self.stream(
+            "POST",
+            "/images/create",
+            params=dict(fromImage=name, tag=tag, platform=platform),
+            headers={"X-Registry-Auth": self.registry_auth(image)},
+        ):
+            pass
+
+    def push(self, image):
+        name, tag = split_image(image)
+        for _ in self.stream(
+            "POST",
+            f"/images/{urllib.parse.quote(name)}/push",
+            params=dict(tag=tag),
+            headers={"X-Registry-Auth": self.registry_auth(image)},
+        ):
+            pass
+
+
+docker_api = DockerClient()
+
+
+BUILDX_BUILDER = "build-farm"
+BUILD_CACHE_TYPES = ("local", "registry")
+# lru_cache doesn't keep concurrent first calls from all creating the builder
+buildx_builder_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def buildx_builder():
+    # Cache export needs a BuildKit builder with the docker-container driver
+    with buildx_builder_lock:
+        try:
+            docker("buildx", "inspect", BUILDX_BUILDER, _out=None, _err=None)
+        except sh.ErrorReturnCode:
+            docker("buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container")
+    return BUILDX_BUILDER
+
+
+def docker_pull(image, platform=None):
+    if docker_api.available() and docker_api.registry_auth(image) is not None:
+        docker_api.pull(image, platform=platform)
+    else:
+        docker("pull", image, *(("--platform", platform) if platform else ()))
+
+
+def docker_push(image):
+    if docker_api.available() and docker_api.registry_auth(image) is not None:
+        docker_api.push(image)
+    else:
+        docker("push", image)
+
+
+def docker_container_ids(name):
+    if docker_api.available():
+        return docker_api.container_ids(name)
+    return docker("ps", "--filter", f"name={name}", "--format", "{{.ID}}", _out=None, _err=None).split()
+
+
+def docker_kill(id):
+    if docker_api.available():
+        docker_api.kill(id)
+    else:
+        docker("kill", id, _out=None, _err=None)
+
+
+class RegistryError(Exception):
+    pass
+
+
+MANIFEST_LIST_TYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
+OCI_INDEX_TYPE = "application/vnd.oci.image.index.v1+json"
+MANIFEST_TYPES = (
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    MANIFEST_LIST_TYPE,
+    OCI_INDEX_TYPE,
+)
+
+
+class RegistryClient:
+    """Client for the registry HTTP API (v2), to assemble manifest lists from
+    registry metadata alone, without pulling the images they reference.
+
+    Connections are pooled per registry and bearer tokens cached per scope.
+    Registries on localhost, and those in BUILD_FARM_INSECURE_REGISTRIES
+    (comma separated), are spoken to over plain http, e.g. a local registry:2
+    started with `docker run -d -p 5000:5000 registry:2`."""
+
+    def __init__(self, config_dir=None):
+        self.config_dir = config_dir
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.tokens = {}
+        self.insecure = set(filter(None, os.environ.get("BUILD_FARM_INSECURE_REGISTRIES", "").split(",")))
+
+    @staticmethod
+    def parse_reference(image):
+        # e.g. "alpine:3.15" -> ("docker.io", "library/alpine", "3.15")
+        registry = image_registry(image)
+        name, tag = split_image(image)
+        if registry == "docker.io":
+            repository = name if "/" in name else f"library/{name}"
+        else:
+            repository = name[len(registry) + 1 :]
+        return registry, repository, tag
+
+    def is_insecure(self, registry):
+        return registry in self.insecure or registry.split(":")[0] in ("localhost", "127.0.0.1")
+
+    @contextlib.contextmanager
+    def connection(self, registry):
+        host = "registry-1.docker.io" if registry == "docker.io" else registry
+        with self.lock:
+            idle = self.idle[registry]
+            if idle:
+                conn = idle.pop()
+            elif self.is_insecure(registry):
+                conn = http.client.HTTPConnection(host, timeout=60)
+            else:
+                conn = http.client.HTTPSConnection(host, timeout=60)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        else:
+            with self.lock:
+                self.idle[registry].append(conn)
+
+    def credentials(self, registry):
+        credentials = docker_config_credentials(load_docker_config(self.config_dir), registry)
+        return credentials[1:] if credentials is not None else None
+
+    def fetch_token(self, registry, challenge, scopes):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        query = [("service", params["service"])] if "service" in params else []
+        query += [("scope", scope) for scope in scopes]
+        request = urllib.request.Request(f"{params['realm']}?{urllib.parse.urlencode(query)}")
+        credentials = self.credentials(registry)
+        if credentials is not None:
+            request.add_header("Authorization", "Basic " + base64.b64encode(":".join(credentials).encode()).decode())
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                token = json.load(response)
+        except (OSError, ValueError) as e:
+            raise RegistryError(f"Could not get a token for {registry}: {e}") from e
+        return token.get("token") or token["access_token"]
+
+    def request(self, method, registry, path, scopes=(), headers=None, body=None):
+        """Make a request, authenticating as challenged, and return
+        (status, headers, content)."""
+        headers = dict(headers or {})
+        key = (registry, tuple(scopes))
+        for attempt in range(2):
+            with self.lock:
+                authorization = self.tokens.get(key)
+            if authorization is not None:
+                headers["Authorization"] = authorization
+            with self.connection(registry) as conn:
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    response = conn.getresponse()
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # The registry closed an idle keep-alive connection, retry once
+                    conn.close()
+                    conn.request(method, path, body=body, headers=headers)
+                    response = conn.getresponse()
+                content = response.read()
+                if response.will_close:
+                    conn.close()
+            if response.status != 401 or attempt:
+                break
+            challenge = response.getheader("WWW-Authenticate", "")
+            if challenge.lower().startswith("bearer "):
+                authorization = "Bearer " + self.fetch_token(registry, challenge, scopes)
+            elif self.credentials(registry) is not None:
+                authorization = "Basic " + base64.b64encode(":".join(self.credentials(registry)).encode()).decode()
+            else:
+                break
+            with self.lock:
+                self.tokens[key] = authorization
+        return response.status, response.headers, content
+
+    def check(self, status, expected, what, content):
+        if status not in expected:
+            raise RegistryError(f"{what}: {status} {content.decode(errors='replace').strip()}")
+
+    def get_manifest(self, registry, repository, reference):
+        """Return (media_type, digest, content) of a manifest by tag or digest."""
+        status, headers, content = self.request(
+            "GET",
+            registry,
+            f"/v2/{repository}/manifests/{reference}",
+            scopes=(f"repository:{repository}:pull",),
+            headers={"Accept": ", ".join(MANIFEST_TYPES)},
+        )
+        self.check(status, (200,), f"GET manifest {repository}:{reference}", content)
+        media_type = json.loads(content).get("mediaType") or headers.get("Content-Type")
+        digest = headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(content).hexdigest()
+        return media_type, digest, content
+
+    def manifest_digest(self, image):
+        registry, repository, reference = self.parse_reference(image)
+        status, headers, content = self.request(
+            "HEAD",
+            registry,
+            f"/v2/{repository}/manifests/{reference}",
+            scopes=(f"repository:{repository}:pull",),
+            headers={"Accept": ", ".join(MANIFEST_TYPES)},
+        )
+        self.check(status, (200,), f"HEAD manifest {image}", content)
+        if "Docker-Content-Digest" not in headers:
+            return self.get_manifest(registry, repository, reference)[1]
+        return headers["Docker-Content-Digest"]
+
+    def get_platform_manifest(self, image, arch):
+        """Return (media_type, digest, content) of the linux/{arch} manifest of
+        image, which may be a single platform image or a manifest list."""
+        registry, repository, reference = self.parse_reference(image)
+        media_type, digest, content = self.get_manifest(registry, repository, reference)
+        if media_type not in (MANIFEST_LIST_TYPE, OCI_INDEX_TYPE):
+            return media_type, digest, content
+
+        platform = manifest_platform(arch)
+        for entry in json.loads(content)["manifests"]:
+            entry_platform = entry.get("platform", {})
+            if (entry_platform.get("architecture"), entry_platform.get("variant")) == (
+                platform["architecture"],
+                platform.get("variant"),
+            ):
+                return self.get_manifest(registry, repository, entry["digest"])
+        raise RegistryError(f"{image} has no linux/{arch} manifest")
+
+    def mount_blob(self, registry, repository, digest, from_repository):
+        status, headers, content = self.request(
+            "POST",
+            registry,
+            f"/v2/{repository}/blobs/uploads/?"
+            + urllib.parse.urlencode(dict(mount=digest, **{"from": from_repository})),
+            scopes=(f"repository:{repository}:pull,push", f"repository:{from_repository}:pull"),
+            headers={"Content-Length": "0"},
+        )
+        if status == 202:
+            # The registry started an upload instead of mounting, cancel it
+            location = urllib.parse.urlparse(headers.get("Location", "")).path
+            if location:
+                self.request("DELETE", registry, location, scopes=(f"repository:{repository}:pull,push",))
+            raise RegistryError(f"Could not mount {digest} from {from_repository} into {repository}")
+        self.check(status, (201,), f"Mount {digest} into {repository}", content)
+
+    def put_manifest(self, registry, repository, reference, media_type, content):
+        status, _, response = self.request(
+            "PUT",
+            registry,
+            f"/v2/{repository}/manifests/{reference}",
+            scopes=(f"repository:{repository}:pull,push",),
+            headers={"Content-Type": media_type},
+            body=content,
+        )
+        self.check(status, (201,), f"PUT manifest {repository}:{reference}", response)
+
+    def push_manifest_list(self, manifest_tags, images, jobs=8):
+        """Push a manifest list for each of manifest_tags, referencing the
+        image for each arch of images ({arch: image})."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            manifests = dict(
+                zip(images, executor.map(lambda arch: self.get_platform_manifest(images[arch], arch), images))
+            )
+
+            for registry, repository in sorted({self.parse_reference(tag)[:2] for tag in manifest_tags}):
+                # A manifest list can only reference manifests in its own
+                # repository, so mount the blobs of each image and push its
+                # manifest by digest.
+                def copy_manifest(arch):
+                    source_registry, source_repository, _ = self.parse_reference(images[arch])
+                    if source_registry != registry:
+                        raise RegistryError(f"Can't reference {images[arch]} from a manifest list in {registry}")
+                    media_type, digest, content = manifests[arch]
+                    if source_repository != repository:
+                        manifest = json.loads(content)
+                        for blob in (manifest["config"], *manifest["layers"]):
+                            self.mount_blob(registry, repository, blob["digest"], source_repository)
+                        self.put_manifest(registry, repository, digest, media_type, content)
+
+                list(executor.map(copy_manifest, images))
+
+                oci = any(media_type.startswith("application/vnd.oci.") for media_type, _, _ in manifests.values())
+                manifest_list = json.dumps(
+                    dict(
+                        schemaVersion=2,
+                        mediaType=OCI_INDEX_TYPE if oci else MANIFEST_LIST_TYPE,
+                        manifests=[
+                            dict(
+                                mediaType=media_type,
+                                digest=digest,
+                                size=len(content),
+                                platform=manifest_platform(arch),
+                            )
+                            for arch, (media_type, digest, content) in manifests.items()
+                        ],
+                    ),
+                    indent=3,
+                ).encode()
+
+                for tag in manifest_tags:
+                    tag_registry, tag_repository, reference = self.parse_reference(tag)
+                    if (tag_registry, tag_repository) == (registry, repository):
+                        with tracer.span("manifest.push", manifest=tag):
+                            self.put_manifest(
+                                registry,
+                                repository,
+                                reference,
+                                OCI_INDEX_TYPE if oci else MANIFEST_LIST_TYPE,
+                                manifest_list,
+                            )
+                        print(f"Pushed manifest list {tag}")
+
+
+registry_client = RegistryClient()
 
 
 class Dumper(yaml.RoundTripDumper):
@@ -49,10 +593,206 @@ class Dumper(yaml.RoundTripDumper):
         return True
 
 
+class Tracer:
+    """Records timed spans of builder phases, tagged with e.g. distro and
+    arch, for export as Chrome trace-event JSON (chrome://tracing, Perfetto)
+    and a per-phase summary."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.events.append(
+                    dict(
+                        name=name,
+                        cat=name.split(".")[0],
+                        ph="X",
+                        ts=(start - self.origin) * 1e6,
+                        dur=(end - start) * 1e6,
+                        pid=os.getpid(),
+                        tid=threading.get_native_id(),
+                        args={key: str(value) for key, value in tags.items()},
+                    )
+                )
+
+    def mark(self):
+        """Return a mark for events_since."""
+        with self.lock:
+            return len(self.events)
+
+    def events_since(self, mark):
+        with self.lock:
+            return self.events[mark:]
+
+    def merge(self, origin, events):
+        """Add the events of another process's tracer, whose origin was origin.
+        perf_counter is system-wide, so only the origins differ."""
+        shift = (origin - self.origin) * 1e6
+        with self.lock:
+            self.events.extend(dict(event, ts=event["ts"] + shift) for event in events)
+
+    def export(self, path):
+        with self.lock, open(path, "w") as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"), f)
+        print(f"Wrote trace to {path}")
+
+    def print_summary(self):
+        phases = collections.defaultdict(list)
+        with self.lock:
+            for event in self.events:
+                phases[event["name"]].append(event["dur"] / 1e6)
+        if not phases:
+            return
+        print(f"{'phase':<20} {'count':>6} {'total':>9} {'mean':>8} {'max':>8}")
+        for name, durations in sorted(phases.items(), key=lambda item: -sum(item[1])):
+            print(
+                f"{name:<20} {len(durations):>6} {sum(durations):>8.2f}s"
+                f" {sum(durations) / len(durations):>7.2f}s {max(durations):>7.2f}s"
+            )
+
+
+tracer = Tracer()
+
+
+class TemplateEnvironment(Environment):
+    """Jinja environment shared by all distros.
+
+    Templates are loaded by path relative to PROJECT_DIR, compiled at most
+    once per process (and re-compiled only if their mtime changes), and
+    their bytecode is persisted under CACHE_DIR so later processes start
+    warm. Load, compile and render times are accumulated for reporting.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.timings_lock = threading.Lock()
+        self.timings = collections.Counter()
+
+    def record_timing(self, phase, seconds):
+        with self.timings_lock:
+            self.timings[f"{phase}_count"] += 1
+            self.timings[f"{phase}_seconds"] += seconds
+
+    def compile(self, source, name=None, filename=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracer.span("template.compile", template=name):
+                return super().compile(source, name, filename, *args, **kwargs)
+        finally:
+            self.record_timing("compile", time.perf_counter() - start)
+
+    def render_template(self, template_path, **context):
+        start = time.perf_counter()
+        template = self.get_template(str(template_path))
+        loaded = time.perf_counter()
+        rendered = template.render(**context)
+        self.record_timing("load", loaded - start)
+        self.record_timing("render", time.perf_counter() - loaded)
+        return rendered
+
+    def print_timings(self):
+        timings = self.timings
+        print(
+            f"Templates: {timings['compile_count']} compiled in {timings['compile_seconds']:.3f}s,"
+            f" {timings['load_count']} loaded in {timings['load_seconds']:.3f}s,"
+            f" {timings['render_count']} rendered in {timings['render_seconds']:.3f}s"
+        )
+
+
+def distro_filter(func):
+    # Bind a template filter to the distro being rendered, so that one
+    # environment can be shared by all distros.
+    @pass_context
+    @functools.wraps(func)
+    def wrapper(context, *args, **kwargs):
+        return func(context["distro"], *args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_env():
+    bytecode_cache_dir = CACHE_DIR / "jinja"
+    os.makedirs(bytecode_cache_dir, exist_ok=True)
+    env = TemplateEnvironment(
+        loader=FileSystemLoader(PROJECT_DIR),
+        bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+        autoescape=False,
+        undefined=StrictUndefined,
+    )
+    env.filters["compiler_archs"] = distro_filter(
+        lambda distro, host_arch: distro.compiler_archs_by_host_arch.get(host_arch)
+    )
+    env.filters["compiler_port"] = distro_filter(lambda distro, arch: distro.ports_by_arch.get(arch))
+    env.filters["stats_port"] = distro_filter(lambda distro, arch: distro.stats_port(arch))
+    env.filters["job_weight"] = distro_filter(lambda distro, arch: distro.job_weights_by_arch.get(arch, 1))
+    env.filters["toolchain"] = distro_filter(lambda distro, arch: distro.toolchains_by_arch.get(arch))
+    env.filters["compiler_path_part"] = distro_filter(lambda distro, arch: distro.get_compiler_path_part(arch))
+    env.filters["host_image_tag"] = distro_filter(lambda distro, *args: distro.host_image_tag(*args))
+    env.filters["client_image_tag"] = distro_filter(lambda distro, *args: distro.client_image_tag(*args))
+    env.filters["apt_pkgs"] = distro_filter(lambda distro, host_arch: distro.get_apt_pkgs(host_arch))
+    env.filters["arch_slug"] = arch_slug
+    env.filters["slugify"] = slugify
+    return env
+
+
+RenderJob = collections.namedtuple("RenderJob", ("distro", "template_path", "out_path", "context", "postprocess"))
+RenderResult = collections.namedtuple("RenderResult", ("template_path", "out_path", "content", "context_hash"))
+
+
+def run_render_job(job):
+    distro = Distro.get(job.distro)
+    with tracer.span("render.template", distro=job.distro, template=job.template_path):
+        with distro.set_context(**job.context):
+            return distro.render_template_content(job.template_path, job.out_path, postprocess=job.postprocess)
+
+
+def run_render_job_in_worker(job):
+    env = get_template_env()
+    timings = env.timings.copy()
+    mark = tracer.mark()
+    result = run_render_job(job)
+    # Report this job's template timings and spans back to the parent process
+    return result, env.timings - timings, (tracer.origin, tracer.events_since(mark))
+
+
+def run_render_jobs(render_jobs, jobs=1):
+    if jobs <= 1 or len(render_jobs) <= 1:
+        return [run_render_job(job) for job in render_jobs]
+
+    results = []
+    env = get_template_env()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunksize = max(1, len(render_jobs) // (jobs * 4))
+        for result, timings, (origin, events) in executor.map(
+            run_render_job_in_worker, render_jobs, chunksize=chunksize
+        ):
+            results.append(result)
+            with env.timings_lock:
+                env.timings.update(timings)
+            tracer.merge(origin, events)
+    return results
+
+
 def slugify(string, delim="-", allowed_chars=""):
     return re.sub(r"[^\w%s]" % re.escape(allowed_chars), delim, string).lower()
 
 
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
 def get_current_arch():
     return sh.sh(
         "-c",
@@ -75,13 +815,16 @@ docker_manifest_args = {
 
 
 def configure_qemu():
-    if not sh.which("qemu-aarch64") and not sh.which("qemu-system-aarch64"):
+    if not shutil.which("qemu-aarch64") and not shutil.which("qemu-system-aarch64"):
         raise RuntimeError(
             "QEMU not installed, install missing pkg (apt: qemu,qemu-user-static | pacman:"
             " qemu-headless,qemu-headless-arch-extra | brew: qemu)."
         )
 
-    images = docker("images", "--format", "{{ .Repository }}", _out=None, _err=None)
+    if docker_api.available():
+        images = " ".join(docker_api.image_repo_tags())
+    else:
+        images = docker("images", "--format", "{{ .Repository }}", _out=None, _err=None)
     if "multiarch/qemu-user-static" not in images:
         docker(
             "run",
@@ -97,10 +840,589 @@ def configure_qemu():
         print("multiarch/qemu-user-static already configured")
 
 
+# lru_cache doesn't keep concurrent first calls from all resetting binfmt,
+# which would break emulated builds already running
+configure_qemu_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def configure_qemu_once():
+    with configure_qemu_lock:
+        try:
+            configure_qemu()
+        except RuntimeError as e:
+            # e.g. Docker Desktop ships its own emulation
+            print(f"Could not configure QEMU, assuming emulation is available: {e}")
+
+
+def require_qemu(arch):
+    # QEMU is configured lazily, the first time code has to run for an arch
+    # this machine can't run natively
+    if is_emulated_arch(arch, get_current_arch()):
+        configure_qemu_once()
+
+
 def arch_slug(arch):
     return arch.replace("arm/", "arm32").replace("arm64/", "arm64")
 
 
+class DistccProtocolError(Exception):
+    pass
+
+
+TestResult = collections.namedtuple("TestResult", ("passed", "seconds", "output"))
+DistccResult = collections.namedtuple("DistccResult", ("status", "stdout", "stderr", "object"))
+
+# Compiled by readiness probes; an empty translation unit is the cheapest job
+DISTCC_PROBE_SOURCE = b"int distcc_probe;\n"
+
+
+def distcc_token(name, value):
+    # distcc protocol tokens are a 4 char name followed by 8 hex digits
+    return f"{name}{value:08x}".encode()
+
+
+def distcc_request(args, source):
+    request = distcc_token("DIST", 1) + distcc_token("ARGC", len(args))
+    for arg in args:
+        request += distcc_token("ARGV", len(arg.encode())) + arg.encode()
+    return request + distcc_token("DOTI", len(source)) + source
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise DistccProtocolError(f"Connection closed after {len(data)} of {size} bytes")
+        data += chunk
+    return data
+
+
+def recv_distcc_token(sock, name):
+    token = recv_exactly(sock, 12)
+    if token[:4] != name.encode():
+        raise DistccProtocolError(f"Expected {name} token, got {token!r}")
+    return int(token[4:], 16)
+
+
+def distcc_compile(host, port, source=DISTCC_PROBE_SOURCE, compiler="gcc", timeout=30):
+    """Send a single (protocol version 1) compile job for preprocessed C source
+    to distccd, and return its DistccResult."""
+    args = [compiler, "-c", "distcc-job.i", "-o", "distcc-job.o"]
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(distcc_request(args, source))
+        recv_distcc_token(sock, "DONE")
+        status = recv_distcc_token(sock, "STAT")
+        stderr = recv_exactly(sock, recv_distcc_token(sock, "SERR"))
+        stdout = recv_exactly(sock, recv_distcc_token(sock, "SOUT"))
+        obj = recv_exactly(sock, recv_distcc_token(sock, "DOTO"))
+    return DistccResult(status, stdout, stderr, obj)
+
+
+# Compiled by load tests; heavy enough that compiling, rather than the
+# protocol, dominates each job
+LOADTEST_SOURCE = "".join(
+    f"int f{i}(int x) {{ for (int i = 0; i < {i + 1}; i++) x = x * 31 + i; return x; }}\n" for i in range(500)
+).encode()
+
+
+def wait_for_distccd(ports, host="127.0.0.1", timeout=120, initial_delay=0.05, max_delay=2):
+    """Poll distccd on each port until it completes a compile handshake.
+
+    Each port is retried with exponential backoff until the overall timeout
+    expires. Returns the seconds each port took to become ready.
+    """
+    start = time.monotonic()
+    ready = {}
+    errors = {}
+    delay = initial_delay
+    pending = list(ports)
+    while pending:
+        for port in list(pending):
+            remaining = timeout - (time.monotonic() - start)
+            try:
+                distcc_compile(host, port, timeout=max(1, min(remaining, 30)))
+            except (OSError, DistccProtocolError) as exc:
+                errors[port] = exc
+                continue
+            ready[port] = time.monotonic() - start
+            pending.remove(port)
+            print(f"distccd on {host}:{port} ready after {ready[port]:.2f}s")
+
+        if not pending:
+            break
+        remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            raise TimeoutError(
+                f"distccd not ready after {timeout}s on "
+                + ", ".join(f"{host}:{port} ({errors[port]!r})" for port in pending)
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+    return ready
+
+
+# Host options for pump mode: preprocess on the host, with lzo compression
+DISTCC_PUMP_OPTIONS = ",cpp,lzo"
+
+# The jobs distcc sends to a TCP host without a /limit
+DISTCC_DEFAULT_HOST_LIMIT = 4
+
+DISTCC_ALLOCATION_PATH = "/var/run/distccd/allocation"
+
+
+def parse_job_allocation(text):
+    # Lines of "<compiler arch> <port> <jobs>", as written by run.sh
+    allocation = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            allocation[fields[0]] = int(fields[2])
+    return allocation
+
+
+def is_emulated_arch(arch, current_arch):
+    if arch == current_arch:
+        return False
+    # 386 containers run natively on amd64 hosts
+    return not (current_arch == "amd64" and arch == "386")
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * pct // 100) - 1)]
+
+
+INPUTS_DIGEST_LABEL = "build-farm.inputs-digest"
+
+
+def manifest_platform(arch):
+    # e.g. "arm/v7" -> {"os": "linux", "architecture": "arm", "variant": "v7"}
+    args = docker_manifest_args[arch]
+    platform = {"os": "linux"}
+    for flag, value in zip(args[::2], args[1::2]):
+        platform["architecture" if flag == "--arch" else flag.lstrip("-")] = value
+    return platform
+
+
+def resolve_image_digest(image, arch):
+    """Resolve the registry digest of image for linux/{arch}, or None if it
+    can't be looked up."""
+    try:
+        inspected = json.loads(
+            str(
+                docker(
+                    "manifest",
+                    "inspect",
+                    "--verbose",
+                    image,
+                    _out=None,
+                    _err=None,
+                    _env={**os.environ, "DOCKER_CLI_EXPERIMENTAL": "enabled"},
+                )
+            )
+        )
+    except (sh.ErrorReturnCode, ValueError):
+        return None
+
+    if isinstance(inspected, dict):
+        # Single platform image
+        return inspected["Descriptor"]["digest"]
+
+    platform = manifest_platform(arch)
+    for entry in inspected:
+        entry_platform = entry["Descriptor"].get("platform", {})
+        if entry_platform.get("architecture") != platform["architecture"]:
+            continue
+        if "variant" in entry_platform and entry_platform["variant"] != platform.get("variant"):
+            continue
+        return entry["Descriptor"]["digest"]
+    return None
+
+
+def image_inputs_digest(image):
+    if docker_api.available():
+        try:
+            labels = docker_api.inspect_image(image)["Config"].get("Labels") or {}
+        except DockerAPIError:
+            return None
+        return labels.get(INPUTS_DIGEST_LABEL, "")
+    try:
+        return str(
+            docker(
+                "image",
+                "inspect",
+                "--format",
+                f'{{{{ index .Config.Labels "{INPUTS_DIGEST_LABEL}" }}}}',
+                image,
+                _out=None,
+                _err=None,
+            )
+        ).strip()
+    except sh.ErrorReturnCode:
+        return None
+
+
+class BuildIndex:
+    """Local index of the inputs digest each image was last built (and
+    possibly pushed) from, stored as JSON under CACHE_DIR."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def is_pushed(self, image, digest):
+        with self.lock:
+            entry = self.load().get(image)
+        return entry is not None and entry["digest"] == digest and entry["pushed"]
+
+    def is_unpushed(self, image, digest):
+        # A local build that is newer than the registry copy of image
+        with self.lock:
+            entry = self.load().get(image)
+        return entry is not None and entry["digest"] == digest and not entry["pushed"]
+
+    def record(self, image, digest, pushed=False):
+        with self.lock:
+            index = self.load()
+            index[image] = dict(digest=digest, pushed=pushed)
+            os.makedirs(self.path.dirname(), exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+
+
+build_index = BuildIndex(CACHE_DIR / "build-index.json")
+
+
+class BuildJournal:
+    """Persistent journal of build-all targets, stored as SQLite under
+    CACHE_DIR. Every build attempt is a row, so it records both what the last
+    run left behind (for --resume) and how long builds have taken."""
+
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    # Skipped by --resume, as unchanged since a previous success
+    RESUMED = "resumed"
+
+    COLUMNS = (
+        "run",
+        "distro",
+        "container_type",
+        "arch",
+        "image",
+        "attempt",
+        "status",
+        "inputs_digest",
+        "image_id",
+        "pushed",
+        "started",
+        "seconds",
+        "error",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connect(self):
+        with self.lock:
+            os.makedirs(self.path.dirname(), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            try:
+                with connection:
+                    connection.execute(
+                        """CREATE TABLE IF NOT EXISTS builds (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            run TEXT NOT NULL,
+                            distro TEXT NOT NULL,
+                            container_type TEXT NOT NULL,
+                            arch TEXT NOT NULL,
+                            image TEXT NOT NULL,
+                            attempt INTEGER NOT NULL,
+                            status TEXT NOT NULL,
+                            inputs_digest TEXT,
+                            image_id TEXT,
+                            pushed INTEGER NOT NULL,
+                            started REAL NOT NULL,
+                            seconds REAL NOT NULL,
+                            error TEXT
+                        )"""
+                    )
+                    connection.execute("CREATE INDEX IF NOT EXISTS builds_image ON builds (image, id)")
+                    yield connection
+            finally:
+                connection.close()
+
+    def record(self, **entry):
+        with self.connect() as connection:
+            connection.execute(
+                f"INSERT INTO builds ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [entry[column] for column in self.COLUMNS],
+            )
+
+    def last_success(self, image):
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM builds WHERE image = ? AND status IN (?, ?) ORDER BY id DESC LIMIT 1",
+                (image, self.SUCCEEDED, self.RESUMED),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    @staticmethod
+    def where(distro=None, arch=None, container_type=None, status=None):
+        clauses, params = [], []
+        for column, value in (
+            ("distro", distro),
+            ("arch", arch),
+            ("container_type", container_type),
+            ("status", status),
+        ):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def query(self, limit=50, **filters):
+        where, params = self.where(**filters)
+        with self.connect() as connection:
+            rows = connection.execute(f"SELECT * FROM builds {where} ORDER BY id DESC LIMIT ?", (*params, limit))
+            return [dict(row) for row in rows]
+
+    def durations(self, **filters):
+        # Per image statistics of the attempts that actually built
+        where, params = self.where(**filters)
+        where = f"{where} AND attempt > 0" if where else "WHERE attempt > 0"
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"""SELECT image, status, COUNT(*) AS builds, AVG(seconds) AS mean, MAX(seconds) AS max,
+                    (SELECT seconds FROM builds AS last WHERE last.image = builds.image
+                        AND last.status = builds.status ORDER BY id DESC LIMIT 1) AS last
+                FROM builds {where} GROUP BY image, status ORDER BY image, status""",
+                params,
+            )
+            return [dict(row) for row in rows]
+
+
+build_journal = BuildJournal(CACHE_DIR / "build-journal.sqlite3")
+
+
+def local_image(image):
+    if docker_api.available():
+        try:
+            return docker_api.inspect_image(image)
+        except DockerAPIError:
+            return None
+    try:
+        return json.loads(str(docker("image", "inspect", image, _out=None, _err=None)))[0]
+    except (sh.ErrorReturnCode, ValueError, IndexError):
+        return None
+
+
+def is_image_current(local, image, platform):
+    """Whether local, the inspected local copy of image, is the registry's
+    current image for platform."""
+    expected = manifest_platform(platform[len("linux/") :])
+    if local.get("Architecture") != expected["architecture"]:
+        return False
+    if local.get("Variant") and local["Variant"] != expected.get("variant"):
+        return False
+    try:
+        remote_digest = registry_client.manifest_digest(image)
+    except (RegistryError, OSError, http.client.HTTPException):
+        return False
+    name, _ = split_image(image)
+    return f"{name}@{remote_digest}" in (local.get("RepoDigests") or ())
+
+
+class Prefetcher:
+    """Pulls images in the background, up to depth images ahead of the builds
+    that need them, so that pulls overlap with builds.
+
+    Images whose local copy is already current are not pulled, nor are those
+    whose local copy is a build not pushed yet. A failed prefetch is only a
+    miss: the build goes ahead as it would without the prefetch."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.lock = threading.Lock()
+        # (image, platform) pairs in the order the builds will need them
+        self.queue = collections.deque()
+        self.futures = {}
+        self.reached_keys = set()
+        # Base image -> the one platform it is prefetched for
+        self.base_platforms = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=depth)
+
+    def schedule(self, image, platform, base=False):
+        with self.lock:
+            if base:
+                # A multi-platform base image has a single local tag, so a pull
+                # for each platform would just replace the previous one.
+                if image in self.base_platforms:
+                    return
+                self.base_platforms[image] = platform
+            self.queue.append((image, platform))
+
+    def base_key(self, image):
+        """The prefetch key of a base image, or None if it isn't prefetched."""
+        with self.lock:
+            platform = self.base_platforms.get(image)
+        return None if platform is None else (image, platform)
+
+    def reached(self, *keys):
+        """Mark keys as needed by a running build and top up the prefetches."""
+        with self.lock:
+            self.reached_keys.update(keys)
+            for key in keys:
+                if key not in self.futures:
+                    # Needed out of order
+                    self.futures[key] = self.executor.submit(self.pull, *key)
+            while self.queue and len(self.futures) < len(self.reached_keys) + self.depth:
+                key = self.queue.popleft()
+                if key not in self.futures:
+                    self.futures[key] = self.executor.submit(self.pull, *key)
+
+    def wait(self, image, platform):
+        """Wait for the prefetch of image, returning whether the local image
+        is now the registry copy."""
+        self.reached((image, platform))
+        with tracer.span("docker.prefetch.wait", image=image, platform=platform):
+            return self.futures[(image, platform)].result()
+
+    def pull(self, image, platform):
+        with tracer.span("docker.prefetch", image=image, platform=platform):
+            try:
+                local = local_image(image)
+                if local is not None:
+                    labels = local.get("Config", {}).get("Labels") or {}
+                    if build_index.is_unpushed(image, labels.get(INPUTS_DIGEST_LABEL)):
+                        print(f"Not prefetching {image}, the local build has not been pushed yet")
+                        return False
+                    if is_image_current(local, image, platform):
+                        print(f"Not prefetching {image} ({platform}), the local copy is current")
+                        return True
+                docker_pull(image, platform=platform)
+            except Exception as e:
+                print(f"Could not prefetch {image} ({platform}): {e!r}")
+                return False
+            return True
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+# Set in the threads running build graph nodes
+build_graph_worker = threading.local()
+
+
+class BuildNode:
+    def __init__(self, key, func, deps=(), pool=None):
+        self.key = key
+        self.func = func
+        self.deps = tuple(deps)
+        self.pool = pool
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({repr(self.key)})"
+
+    @property
+    def label(self):
+        return " ".join(self.key)
+
+
+class BuildGraph:
+    """A DAG of build steps run on a bounded worker pool.
+
+    Each node may belong to a pool (e.g. "native" or "emulated") whose
+    concurrency is capped separately from the total number of jobs. When a
+    node fails, only the nodes depending on it are cancelled; independent
+    nodes keep running.
+    """
+
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self):
+        self.nodes = {}
+        self.dependents = collections.defaultdict(list)
+
+    def add(self, key, func, deps=(), pool=None):
+        if key in self.nodes:
+            raise ValueError(f"Duplicate build node {key}")
+        for dep in deps:
+            # Requiring dependencies to be added first keeps the graph acyclic
+            if dep not in self.nodes:
+                raise ValueError(f"Build node {key} depends on unknown node {dep}")
+            self.dependents[dep].append(key)
+        self.nodes[key] = BuildNode(key, func, deps=deps, pool=pool)
+        return self.nodes[key]
+
+    def run(self, jobs=1, pool_limits=None):
+        pool_limits = pool_limits or {}
+        status = {}
+        pending = dict(self.nodes)
+        running = {}
+        running_by_pool = collections.Counter()
+
+        def cancel_dependents(key):
+            for dependent in self.dependents[key]:
+                if dependent in pending:
+                    del pending[dependent]
+                    status[dependent] = self.CANCELLED
+                    print(f"Cancelled {self.nodes[dependent].label} (depends on {self.nodes[key].label})")
+                    cancel_dependents(dependent)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                for key, node in list(pending.items()):
+                    if len(running) >= jobs:
+                        break
+                    if not all(status.get(dep) == self.SUCCEEDED for dep in node.deps):
+                        continue
+                    limit = pool_limits.get(node.pool)
+                    if limit is not None and running_by_pool[node.pool] >= limit:
+                        continue
+                    del pending[key]
+                    running[executor.submit(self.run_node, node)] = node
+                    running_by_pool[node.pool] += 1
+
+                if not running:
+                    raise RuntimeError(f"Cannot schedule build nodes {list(pending)} with pool limits {pool_limits}")
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    running_by_pool[node.pool] -= 1
+                    exc = future.exception()
+                    if exc is None:
+                        status[node.key] = self.SUCCEEDED
+                    else:
+                        status[node.key] = self.FAILED
+                        print(f"Failed {node.label}: {exc!r}", file=sys.stderr)
+                        cancel_dependents(node.key)
+        return status
+
+    @staticmethod
+    def run_node(node):
+        build_graph_worker.active = True
+        try:
+            return node.func()
+        finally:
+            build_graph_worker.active = False
+
+
 class Distro(metaclass=abc.ABCMeta):
     template_path = None
     registry = {}
@@ -109,6 +1431,10 @@ class Distro(metaclass=abc.ABCMeta):
     ports_by_arch = {}
     toolchains_by_arch = {}
     compiler_archs_by_host_arch = {}
+    # Relative share of a host's distccd job slots per compiler arch, default 1
+    job_weights_by_arch = {}
+    # Port of a host's Prometheus /metrics endpoint
+    metrics_port = None
 
     def __init__(
         self,
@@ -124,18 +1450,19 @@ class Distro(metaclass=abc.ABCMeta):
         self.client_pkg = client_pkg
         self.registry[name] = self
         self._context = None
-        self.env = Environment(autoescape=False, undefined=StrictUndefined)
-        self.env.filters["compiler_archs"] = self.compiler_archs_by_host_arch.get
-        self.env.filters["compiler_port"] = self.ports_by_arch.get
-        self.env.filters["toolchain"] = self.toolchains_by_arch.get
-        self.env.filters["compiler_path_part"] = self.get_compiler_path_part
-        self.env.filters["host_image_tag"] = self.host_image_tag
-        self.env.filters["client_image_tag"] = self.client_image_tag
-        self.env.filters["arch_slug"] = arch_slug
+        self._render_lock = threading.Lock()
+        self._rendered_key = None
+        self._outputs = None
+        self._output_changes = None
+        self._render_jobs = None
 
     def __repr__(self):
         return f"{self.__class__.__name__}({repr(self.name)})"
 
+    @property
+    def env(self):
+        return get_template_env()
+
     @classmethod
     def get(cls, name):
         if name not in cls.registry:
@@ -148,17 +1475,151 @@ class Distro(metaclass=abc.ABCMeta):
             distro.clean()
 
     @classmethod
-    def render_all(cls, **context):
-        for distro in cls.registry.values():
-            distro.render(**context)
+    def render_all(cls, jobs=1, copy_build_contexts=True, **context):
+        cls.render_many(cls.registry.values(), jobs=jobs, copy_build_contexts=copy_build_contexts, **context)
+        get_template_env().print_timings()
 
     @classmethod
-    def build_all(cls, version, push=False):
+    def render_many(cls, distros, jobs=1, copy_build_contexts=True, **context):
+        if getattr(build_graph_worker, "active", False):
+            # Rendering rewrites a distro's context and output tree, which the
+            # other workers may be building from at the same time.
+            raise RuntimeError("Distros must be rendered before their build graph runs, not by its nodes")
+        # Rendering is memoized per context and template inputs, so repeated
+        # builds of the same version reuse the already-rendered tree.
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(tracer.span("render", distros=",".join(distro.name for distro in distros), jobs=jobs))
+            plans = []
+            for distro in distros:
+                stack.enter_context(distro._render_lock)
+                key = (
+                    json.dumps(context, sort_keys=True, default=str),
+                    copy_build_contexts,
+                    distro.template_inputs_digest(),
+                )
+                if key == distro._rendered_key and os.path.exists(PROJECT_DIR / distro.out_path):
+                    print(f"{distro.out_path} is up to date, not re-rendering")
+                    continue
+                distro._rendered_key = None
+                plans.append((distro, key, distro.plan_render(**context)))
+
+            # Templates of all distros are rendered together so that a process
+            # pool can fan them out; results come back in plan order.
+            results = iter(run_render_jobs([job for _, _, render_jobs in plans for job in render_jobs], jobs=jobs))
+            for distro, key, render_jobs in plans:
+                with tracer.span("render.write", distro=distro.name):
+                    distro.write_render(
+                        [next(results) for _ in render_jobs],
+                        copy_build_contexts=copy_build_contexts,
+                    )
+                distro._rendered_key = key
+
+    @classmethod
+    def build_all(
+        cls,
+        version,
+        push=False,
+        jobs=1,
+        native_jobs=None,
+        emulated_jobs=None,
+        force=False,
+        stream_context=False,
+        prefetch=2,
+        cache=None,
+        cross_build=False,
+        ccache=False,
+        pump=False,
+        metrics=False,
+        inventory=None,
+        resume=False,
+        retry=0,
+        retry_delay=10,
+    ):
+        current_arch = get_current_arch()
+        graph = BuildGraph()
+        # Identifies this invocation's rows in the build journal; unlike a
+        # timestamp, it is unique even for concurrent invocations
+        run = uuid.uuid4().hex
+        journal_kwargs = dict(run=run, push=push, resume=resume, retry=retry, retry_delay=retry_delay)
+        # Pulls upcoming images, and their base images, in the background
+        # while earlier ones build
+        prefetcher = Prefetcher(prefetch) if prefetch else None
+        build_kwargs = dict(
+            version=version,
+            push=push,
+            render=False,
+            force=force,
+            stream_context=stream_context,
+            prefetcher=prefetcher,
+            cache=cache,
+        )
         for distro in cls.registry.values():
+            # Render each tree once up front; the builds below share it, so
+            # they run with render=False
+            distro.render(
+                version=version,
+                copy_build_contexts=not stream_context,
+                cross_build=cross_build,
+                ccache=ccache,
+                pump=pump,
+                metrics=metrics,
+                inventory=inventory,
+            )
             for host_arch in distro.host_archs:
-                distro.build_host(host_arch, version=version, push=push)
-                for compiler_arch in distro.compiler_archs_by_host_arch[host_arch]:
-                    distro.build_client(host_arch, compiler_arch, version=version, push=push)
+                graph.add(
+                    ("host", distro.name, host_arch),
+                    functools.partial(
+                        distro.build_journaled,
+                        "host",
+                        host_arch,
+                        distro.host_image_tag(version, host_arch),
+                        functools.partial(distro.build_host, host_arch, **build_kwargs),
+                        **journal_kwargs,
+                    ),
+                    pool="emulated" if is_emulated_arch(host_arch, current_arch) else "native",
+                )
+                if prefetcher is not None:
+                    prefetcher.schedule(distro.host_image_tag(version, host_arch), f"linux/{host_arch}")
+                    prefetcher.schedule(
+                        distro.from_image(host_arch), distro.base_prefetch_platform(host_arch, current_arch), base=True
+                    )
+            for compiler_arch in distro.compiler_archs:
+                host_arch = distro.get_test_host_arch(compiler_arch, current_arch)
+                graph.add(
+                    ("client", distro.name, compiler_arch),
+                    functools.partial(
+                        distro.build_journaled,
+                        "client",
+                        compiler_arch,
+                        distro.client_image_tag(version, compiler_arch),
+                        functools.partial(distro.build_client, compiler_arch, host_arch=host_arch, **build_kwargs),
+                        **journal_kwargs,
+                    ),
+                    deps=[("host", distro.name, host_arch)],
+                    pool="emulated" if is_emulated_arch(compiler_arch, current_arch) else "native",
+                )
+                if prefetcher is not None:
+                    prefetcher.schedule(distro.client_image_tag(version, compiler_arch), f"linux/{compiler_arch}")
+                    prefetcher.schedule(
+                        distro.from_image(compiler_arch),
+                        distro.base_prefetch_platform(compiler_arch, current_arch),
+                        base=True,
+                    )
+
+        if prefetcher is not None:
+            prefetcher.reached()
+        try:
+            status = graph.run(jobs=jobs, pool_limits={"native": native_jobs, "emulated": emulated_jobs})
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+        for key, node in graph.nodes.items():
+            print(f"{status[key]:>10} {node.label}")
+        print(f"Build journal run {run} recorded in {build_journal.path}")
+        failed = [key for key, node_status in status.items() if node_status != BuildGraph.SUCCEEDED]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(status)} builds did not succeed")
 
     @property
     def context(self):
@@ -207,68 +1668,201 @@ class Distro(metaclass=abc.ABCMeta):
         finally:
             self._context = prev_context
 
-    def render_template(self, template_path, out_path):
-        with PROJECT_DIR:
-            template_path = template_path.format(**self.context)
-            with open(template_path, "r") as f:
-                rendered = self.env.from_string(f.read()).render(**self.context)
-            out_path = out_path.format(**self.context)
-            dir_name = os.path.dirname(out_path)
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
-
-            lines = rendered.split("\n")
-            if lines and lines[0].startswith("#!"):
-                lines.insert(1, f"# Rendered from {template_path}\n")
-            else:
-                lines.insert(0, f"# Rendered from {template_path}\n")
-                if out_path.endswith(".yml"):
-                    lines.insert(1, "\n")
-                    lines.insert(1, "# yamllint disable rule:indentation")
-                    lines.insert(1, "# yamllint disable rule:line-length")
-                    lines.insert(1, "# yamllint disable rule:new-line-at-end-of-file")
-                    lines.insert(1, "# yamllint disable rule:trailing-spaces")
-
-            rendered = "\n".join(lines)
+    def render_template(self, template_path, out_path, postprocess=None):
+        job = RenderJob(
+            distro=self.name,
+            template_path=str(template_path),
+            out_path=str(out_path),
+            context={key: value for key, value in self.context.items() if key != "distro"},
+            postprocess=postprocess,
+        )
+        if self._render_jobs is not None:
+            # Planning a render, the job will be run by render_many
+            self._render_jobs.append(job)
+        else:
+            self.write_render_result(run_render_job(job))
+
+    def render_template_content(self, template_path, out_path, postprocess=None):
+        template_path = template_path.format(**self.context)
+        rendered = self.env.render_template(template_path, **self.context)
+        out_path = out_path.format(**self.context)
+
+        lines = rendered.split("\n")
+        # Shebangs and Dockerfile parser directives have to stay on the first line
+        if lines and lines[0].startswith(("#!", "# syntax=")):
+            lines.insert(1, f"# Rendered from {template_path}\n")
+        else:
+            lines.insert(0, f"# Rendered from {template_path}\n")
+            if out_path.endswith(".yml"):
+                lines.insert(1, "\n")
+                lines.insert(1, "# yamllint disable rule:indentation")
+                lines.insert(1, "# yamllint disable rule:line-length")
+                lines.insert(1, "# yamllint disable rule:new-line-at-end-of-file")
+                lines.insert(1, "# yamllint disable rule:trailing-spaces")
+
+        rendered = "\n".join(lines)
+        if postprocess is not None:
+            rendered = getattr(self, postprocess)(rendered)
+
+        return RenderResult(template_path, out_path, rendered.encode(), self.context_hash())
+
+    def write_render_result(self, result):
+        if self.write_output(result.out_path, result.content, result.template_path, result.context_hash):
+            print(f"Rendered {result.template_path} -> {result.out_path}")
+
+    def interpolate_yaml(self, rendered):
+        rendered = yaml.load(rendered, Loader=yaml.RoundTripLoader)
+
+        # Remove _anchors section
+        if "_anchors" in rendered:
+            del rendered["_anchors"]
+
+        # Use custom Dumper that replaces aliases with referenced content
+        return yaml.dump(rendered, Dumper=Dumper)
+
+    def context_hash(self):
+        context = {key: value for key, value in self.context.items() if key != "distro"}
+        return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+
+    def write_output(self, out_path, content, source, context_hash=None):
+        """Write content to out_path (relative to PROJECT_DIR) unless it is
+        already identical, so that unchanged outputs keep their mtimes.
+
+        Returns the change ("added" or "changed"), or None if unchanged.
+        """
+        out_path = Path(out_path)
+        abs_out_path = PROJECT_DIR / out_path
+        digest = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(abs_out_path):
+            change = "added"
+        elif file_digest(abs_out_path) != digest:
+            change = "changed"
+        else:
+            change = None
+
+        if change is not None:
+            os.makedirs(abs_out_path.dirname(), exist_ok=True)
+            with open(abs_out_path, "wb") as f:
+                f.write(content)
+
+        if self._outputs is not None:
+            self._outputs[str(out_path)] = dict(source=str(source), context=context_hash, digest=digest)
+            # A path may be written more than once per render, keep its first change
+            if self._output_changes.get(str(out_path)) is None:
+                self._output_changes[str(out_path)] = change
+        return change
+
+    def build_context_dirs(self, container_type):
+        # Source directories merged into a build context; later ones take precedence
+        return (
+            self.template_path / container_type / "build-context",
+            Path("shared-build-context") / container_type,
+            Path("shared-build-context/shared"),
+        )
 
-            with open(out_path, "w") as f:
-                f.write(rendered)
-            print(f"Rendered {template_path} -> {out_path}")
-            return out_path
+    def build_context_sources(self, container_type):
+        sources = {}
+        for src_dir in self.build_context_dirs(container_type):
+            for root, dirs, files in os.walk(PROJECT_DIR / src_dir):
+                dirs.sort()
+                # Paths stay relative to PROJECT_DIR, e.g. in render manifests
+                root = Path(root).relpath(PROJECT_DIR)
+                for f in sorted(files):
+                    if ".jinja" in f:
+                        continue
+                    sources[Path(os.path.normpath(root.relpath(src_dir) / f))] = root / f
+        return sources
+
+    def build_context_files(self, container_type):
+        """List the (arcname, path) of every file in a build context: the
+        source files, plus the rendered files in the output tree."""
+        files = self.build_context_sources(container_type)
+        context_dir = self.out_path / container_type / "build-context"
+        for root, dirs, filenames in os.walk(PROJECT_DIR / context_dir):
+            root = Path(root).relpath(PROJECT_DIR)
+            for f in filenames:
+                files.setdefault(Path(os.path.normpath(root.relpath(context_dir) / f)), root / f)
+        return sorted(files.items())
+
+    def copied_files(self):
+        # Non-template files copied verbatim into the output tree
+        return [
+            (src, Path(os.path.normpath(self.out_path / container_type / "build-context" / arcname)))
+            for container_type in ("host", "client")
+            for arcname, src in self.build_context_sources(container_type).items()
+        ]
+
+    def build_context_tar(self, container_type, dockerfile):
+        """Assemble a build context as an in-memory tar, straight from the
+        source directories and rendered files, for `docker build -`."""
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for arcname, path in [*self.build_context_files(container_type), ("Dockerfile", dockerfile)]:
+                path = PROJECT_DIR / path
+                info = tarfile.TarInfo(arcname)
+                info.size = os.path.getsize(path)
+                # Normalize metadata so the context only varies with content
+                info.mode = 0o755 if os.access(path, os.X_OK) else 0o644
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+        return buf.getvalue()
 
-    def interpolate_yaml(self, yaml_path):
-        with PROJECT_DIR:
-            yaml_path = yaml_path.format(**self.context)
-            with open(yaml_path, "r") as f:
-                rendered = yaml.load(f, Loader=yaml.RoundTripLoader)
+    @property
+    def render_manifest_path(self):
+        return self.out_path / ".render-manifest.json"
 
-            # Remove _anchors section
-            if "_anchors" in rendered:
-                del rendered["_anchors"]
+    def load_render_manifest(self):
+        if not os.path.exists(PROJECT_DIR / self.render_manifest_path):
+            return {}
+        with open(PROJECT_DIR / self.render_manifest_path, "r") as f:
+            return json.load(f)
 
-            # Use custom Dumper that replaces aliases with referenced content
-            rendered = yaml.dump(rendered, Dumper=Dumper)
+    @property
+    def client_dockerfile_path(self):
+        return self.out_path / "client/Dockerfile"
 
-            with open(yaml_path, "w") as f:
-                f.write(rendered)
+    def client_stage(self, compiler_arch):
+        # Stage names can't start with a digit, e.g. "386"
+        return f"client-{arch_slug(compiler_arch)}"
 
-            print(f"Interpolated {yaml_path}")
-            return yaml_path
+    @property
+    def client_base_stages(self):
+        """(stage, from image, compiler archs) of the stages shared by the
+        client images, one per distinct base image."""
+        compiler_archs_by_from_image = {}
+        for compiler_arch in self.compiler_archs:
+            compiler_archs_by_from_image.setdefault(self.from_image(compiler_arch), []).append(compiler_arch)
+        return [
+            (f"base-{slugify(from_image)}", from_image, compiler_archs)
+            for from_image, compiler_archs in compiler_archs_by_from_image.items()
+        ]
 
     @property
     def docker_compose_yml_path(self):
         return self.out_path / f"docker-compose.yml"
 
+    def distcc_hosts_env_path(self, compiler_arch):
+        return self.out_path / f"client/distcc-hosts-{arch_slug(compiler_arch)}.env"
+
+    def ccache_volume(self, container_type, compiler_arch):
+        return f"build-farm-ccache-{container_type}-{self.slug}-{arch_slug(compiler_arch)}"
+
+    @property
+    def allocation_volume(self):
+        # Shares the hosts' job allocations with the client containers
+        return f"build-farm-allocation-{self.slug}"
+
     @property
     def github_actions_yml_path(self):
         return Path(f".github/workflows/{self.slug}.yml")
 
     def clean(self):
-        if os.path.exists(self.out_path):
-            shutil.rmtree(self.out_path)
+        self._rendered_key = None
+        if os.path.exists(PROJECT_DIR / self.out_path):
+            shutil.rmtree(PROJECT_DIR / self.out_path)
             print(f"Removed {self.out_path}")
-        if os.path.exists(self.github_actions_yml_path):
-            os.unlink(self.github_actions_yml_path)
+        if os.path.exists(PROJECT_DIR / self.github_actions_yml_path):
+            os.unlink(PROJECT_DIR / self.github_actions_yml_path)
             print(f"Removed {self.github_actions_yml_path}")
 
     @property
@@ -278,6 +1872,85 @@ class Distro(metaclass=abc.ABCMeta):
     def from_image(self, arch):
         return self.name
 
+    def base_prefetch_platform(self, arch, current_arch):
+        # Prefer the native platform of a base image shared by several archs
+        if current_arch in {*self.host_archs, *self.compiler_archs} and (
+            self.from_image(current_arch) == self.from_image(arch)
+        ):
+            return f"linux/{current_arch}"
+        return f"linux/{arch}"
+
+    @property
+    def bake_group(self):
+        # Bake names may only contain letters, digits, "-" and "_"
+        return slugify(self.slug)
+
+    def bake_target(self, container_type, arch):
+        return f"{self.bake_group}-{container_type}-{arch_slug(arch)}"
+
+    def build_cache(self, container_type, arch, cache):
+        """BuildKit (cache-from, cache-to) for an image. The cache is keyed per
+        distro and arch rather than per version, so that layers are reused
+        across versions. cache-from is None until a local cache exists."""
+        key = f"{container_type}--{self.slug}--{arch_slug(arch)}"
+        if cache == "local":
+            path = CACHE_DIR / "buildkit" / key
+            cache_from = f"type=local,src={path}" if os.path.exists(path / "index.json") else None
+            return cache_from, f"type=local,dest={path},mode=max"
+        if cache == "registry":
+            ref = f"{self.tmp_pkg}:cache--{key}"
+            return f"type=registry,ref={ref}", f"type=registry,ref={ref},mode=max"
+        raise ValueError(f"Unknown build cache type {cache}")
+
+    def distcc_hosts(self, inventory, pump=False):
+        """Return the DISTCC_HOSTS of each compiler arch provided by the
+        inventory hosts running this distro, with each host limited to its
+        compiler arch's share of the host's job slots."""
+        entries_by_arch = {}
+        for host in inventory:
+            if host["distro"] != self.name:
+                continue
+            if host["arch"] not in self.host_archs:
+                raise ValueError(f"{self.name} has no linux/{host['arch']} host, inventory host {host['address']}")
+            compiler_archs = self.compiler_archs_by_host_arch[host["arch"]]
+            # Same split as the host's run.sh, see "Job slots" in the README
+            weights = {
+                compiler_arch: host.get("weights", {}).get(
+                    compiler_arch, self.job_weights_by_arch.get(compiler_arch, 1)
+                )
+                for compiler_arch in compiler_archs
+            }
+            for compiler_arch in compiler_archs:
+                entry = f"{host['address']}:{self.ports_by_arch[compiler_arch]}"
+                if host.get("jobs"):
+                    limit = max(1, host["jobs"] * weights[compiler_arch] // sum(weights.values()))
+                    entry += f"/{limit}"
+                else:
+                    # Without known job slots, leave distcc's default limit
+                    limit = DISTCC_DEFAULT_HOST_LIMIT
+                if pump:
+                    entry += DISTCC_PUMP_OPTIONS
+                entries_by_arch.setdefault(compiler_arch, []).append((limit, entry))
+
+        # distcc prefers the hosts listed first, so list the roomiest first
+        return {
+            compiler_arch: " ".join(entry for _, entry in sorted(entries, key=lambda entry: -entry[0]))
+            for compiler_arch, entries in entries_by_arch.items()
+        }
+
+    def stats_port(self, compiler_arch):
+        # distccd's stats are only read from inside the host container
+        return str(int(self.ports_by_arch[compiler_arch]) + 1000)
+
+    def get_test_host_arch(self, compiler_arch, current_arch):
+        # Prefer testing clients against a host image that runs natively
+        if compiler_arch in self.compiler_archs_by_host_arch.get(current_arch, ()):
+            return current_arch
+        for host_arch in self.host_archs:
+            if compiler_arch in self.compiler_archs_by_host_arch[host_arch]:
+                return host_arch
+        raise ValueError(f"No {self.name} host arch provides a compiler for {compiler_arch}")
+
     @abc.abstractmethod
     def get_compiler_path_part(self, compiler_arch):
         ...
@@ -291,6 +1964,15 @@ class Distro(metaclass=abc.ABCMeta):
         return slugify(self.name, "_")
 
     def get_template_context(self, **context):
+        # Render options
+        context.setdefault("cross_build", False)
+        context.setdefault("ccache", False)
+        context.setdefault("pump", False)
+        context.setdefault("metrics", False)
+        if context["pump"] and context["ccache"]:
+            # ccache preprocesses locally, which is what pump mode avoids
+            raise ValueError("pump mode and ccache can't be combined")
+        context.setdefault("inventory", None)
         context.update(
             dict(
                 distro=self,
@@ -298,74 +1980,80 @@ class Distro(metaclass=abc.ABCMeta):
         )
         return context
 
-    def render(self, **context):
-        with self.set_context(**context):
-            self.render_dockerfile_host()
-            self.render_dockerfile_client()
-            self.render_run_sh()
-            self.render_docker_compose()
-            self.render_github_actions()
-
-            with PROJECT_DIR:
-                for root, _, files in os.walk(self.template_path):
-                    root = Path(root)
-                    new_root = Path(root.replace(self.template_path, self.out_path))
-                    for f in files:
-                        if ".jinja" in f:
-                            continue
-                        if not os.path.exists(os.path.dirname(new_root / f)):
-                            os.makedirs(os.path.dirname(new_root / f))
-                        shutil.copyfile(root / f, new_root / f)
-                        print(f"Copied {root / f} -> {new_root / f}")
-
-                for root, _, files in os.walk(Path("shared-build-context") / "host"):
-                    root = Path(root)
-                    new_root = Path(
-                        root.replace(
-                            "shared-build-context/host",
-                            self.out_path / "host/build-context",
-                        )
-                    )
-                    for f in files:
-                        if ".jinja" in f:
-                            continue
-                        if not os.path.exists(os.path.dirname(new_root / f)):
-                            os.makedirs(os.path.dirname(new_root / f))
-                        shutil.copyfile(root / f, new_root / f)
-                        print(f"Copied {root / f} -> {new_root / f}")
-
-                for root, _, files in os.walk(Path("shared-build-context") / "client"):
-                    root = Path(root)
-                    new_root = Path(
-                        root.replace(
-                            "shared-build-context/client",
-                            self.out_path / "client/build-context",
-                        )
-                    )
-                    for f in files:
-                        if ".jinja" in f:
-                            continue
-                        if not os.path.exists(os.path.dirname(new_root / f)):
-                            os.makedirs(os.path.dirname(new_root / f))
-                        shutil.copyfile(root / f, new_root / f)
-                        print(f"Copied {root / f} -> {new_root / f}")
-
-                for root, _, files in os.walk(Path("shared-build-context") / "shared"):
-                    root = Path(root)
-                    for container_type in ("host", "client"):
-                        new_root = Path(
-                            root.replace(
-                                "shared-build-context/shared",
-                                self.out_path / container_type / "build-context",
-                            )
-                        )
-                        for f in files:
-                            if ".jinja" in f:
-                                continue
-                            if not os.path.exists(os.path.dirname(new_root / f)):
-                                os.makedirs(os.path.dirname(new_root / f))
-                            shutil.copyfile(root / f, new_root / f)
-                            print(f"Copied {root / f} -> {new_root / f}")
+    @property
+    def template_input_paths(self):
+        return (
+            self.template_path,
+            Path("shared-build-context"),
+            Path(".github/workflows/build.yml.jinja"),
+        )
+
+    def template_inputs_digest(self):
+        digest = hashlib.sha256()
+        for input_path in self.template_input_paths:
+            input_path = PROJECT_DIR / input_path
+            if os.path.isfile(input_path):
+                paths = [input_path]
+            else:
+                paths = sorted(Path(root) / f for root, _, files in os.walk(input_path) for f in files)
+            for path in paths:
+                stat = os.stat(path)
+                digest.update(f"{path.relpath(PROJECT_DIR)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def render(self, jobs=1, copy_build_contexts=True, **context):
+        self.render_many([self], jobs=jobs, copy_build_contexts=copy_build_contexts, **context)
+
+    def plan_render(self, **context):
+        self._render_jobs = []
+        try:
+            with self.set_context(**context):
+                self.render_dockerfile_host()
+                self.render_dockerfile_client()
+                self.render_run_sh()
+                self.render_docker_compose()
+                self.render_distcc_hosts_env()
+                self.render_github_actions()
+            return self._render_jobs
+        finally:
+            self._render_jobs = None
+
+    def write_render(self, results, copy_build_contexts=True):
+        manifest = self.load_render_manifest()
+        self._outputs = {}
+        self._output_changes = {}
+        try:
+            for result in results:
+                self.write_render_result(result)
+
+            # When build contexts are streamed, previously copied files are
+            # no longer produced and get removed below.
+            with tracer.span("render.copy", distro=self.name):
+                for src, dst in self.copied_files() if copy_build_contexts else ():
+                    with open(PROJECT_DIR / src, "rb") as f:
+                        content = f.read()
+                    if self.write_output(dst, content, src):
+                        print(f"Copied {src} -> {dst}")
+
+            # Remove outputs of the previous render which are no longer produced
+            removed = sorted(set(manifest) - set(self._outputs))
+            for out_path in removed:
+                if os.path.exists(PROJECT_DIR / out_path):
+                    os.unlink(PROJECT_DIR / out_path)
+                    print(f"Removed {out_path}")
+
+            if self._outputs != manifest:
+                with open(PROJECT_DIR / self.render_manifest_path, "w") as f:
+                    json.dump(self._outputs, f, indent=2, sort_keys=True)
+        finally:
+            changes = collections.Counter(self._output_changes.values())
+            self._outputs = None
+            self._output_changes = None
+
+        print(
+            f"Rendered {self.out_path}: {changes['added']} added, {changes['changed']} changed,"
+            f" {len(removed)} removed, {changes[None]} unchanged"
+        )
 
     def render_dockerfile_host(self):
         for host_arch in self.host_archs:
@@ -376,13 +2064,12 @@ class Distro(metaclass=abc.ABCMeta):
                 )
 
     def render_dockerfile_client(self):
-        for host_arch in self.host_archs:
-            for compiler_arch in self.compiler_archs_by_host_arch[host_arch]:
-                with self.set_context(host_arch=host_arch, compiler_arch=compiler_arch):
-                    self.render_template(
-                        self.template_path / "client/Dockerfile.jinja",
-                        self.out_path / "client" / f"Dockerfile.{arch_slug(compiler_arch)}",
-                    )
+        # A single multi-stage Dockerfile for all compiler archs; each arch's
+        # image is its final stage.
+        self.render_template(
+            self.template_path / "client/Dockerfile.jinja",
+            self.client_dockerfile_path,
+        )
 
     def render_docker_compose(self):
         self.render_template(
@@ -390,14 +2077,24 @@ class Distro(metaclass=abc.ABCMeta):
             self.docker_compose_yml_path,
         )
 
+    def render_distcc_hosts_env(self):
+        if not self.context["inventory"]:
+            return
+        for compiler_arch in self.distcc_hosts(self.context["inventory"], pump=self.context["pump"]):
+            with self.set_context(compiler_arch=compiler_arch):
+                self.render_template(
+                    "shared-build-context/client/distcc-hosts.env.jinja",
+                    self.distcc_hosts_env_path(compiler_arch),
+                )
+
     def render_github_actions(self):
         with self.set_context():
+            # Replace YAML aliases in rendered jinja output
             self.render_template(
                 Path(".github/workflows/build.yml.jinja"),
                 self.github_actions_yml_path,
+                postprocess="interpolate_yaml",
             )
-            # Replace YAML aliases in rendered jinja output
-            self.interpolate_yaml(self.github_actions_yml_path)
 
     def render_run_sh(self):
         for host_arch in self.host_archs:
@@ -407,159 +2104,606 @@ class Distro(metaclass=abc.ABCMeta):
                     self.out_path / f"host/build-context/scripts/run-{arch_slug(host_arch)}.sh",
                 )
 
-    def build_host(self, host_arch, version, push=False):
-        self.render(version=version)
+    def build_host(
+        self,
+        host_arch,
+        version,
+        push=False,
+        render=True,
+        force=False,
+        stream_context=False,
+        prefetcher=None,
+        cache=None,
+        cross_build=False,
+        ccache=False,
+        pump=False,
+        metrics=False,
+        inventory=None,
+    ):
+        if render:
+            self.render(
+                version=version,
+                copy_build_contexts=not stream_context,
+                cross_build=cross_build,
+                ccache=ccache,
+                pump=pump,
+                metrics=metrics,
+                inventory=inventory,
+            )
 
-        image = self.host_image_tag(version, host_arch)
-        dockerfile = self.out_path / f"host/Dockerfile.{arch_slug(host_arch)}"
-        try:
-            docker("pull", image, "--platform", f"linux/{host_arch}")
-        except ErrorReturnCode_1:
-            pass
-        docker(
-            "build",
-            self.out_path / "host/build-context",
-            "--file",
+        dockerfile, target = self.image_source("host", host_arch)
+        return self.build_image(
+            self.host_image_tag(version, host_arch),
             dockerfile,
-            "--tag",
-            image,
-            "--cache-from",
-            image,
-            "--platform",
-            f"linux/{host_arch}",
-            "--progress",
-            "plain",
+            "host",
+            host_arch,
+            push=push,
+            force=force,
+            stream_context=stream_context,
+            prefetcher=prefetcher,
+            cache=cache,
+            target=target,
         )
-        if push:
-            docker("push", image)
 
-    def build_client(self, client_arch, version, host_arch=None, push=False):
+    def build_client(
+        self,
+        client_arch,
+        version,
+        host_arch=None,
+        push=False,
+        render=True,
+        force=False,
+        stream_context=False,
+        prefetcher=None,
+        cache=None,
+        cross_build=False,
+        ccache=False,
+        pump=False,
+        metrics=False,
+        inventory=None,
+    ):
         if host_arch is None:
             host_arch = get_current_arch()
 
-        self.render(version=version)
+        if render:
+            self.render(
+                version=version,
+                copy_build_contexts=not stream_context,
+                cross_build=cross_build,
+                ccache=ccache,
+                pump=pump,
+                metrics=metrics,
+                inventory=inventory,
+            )
 
-        image = self.client_image_tag(version, client_arch)
-        dockerfile = self.out_path / f"client/Dockerfile.{arch_slug(client_arch)}"
-        try:
-            docker("pull", image, "--platform", f"linux/{client_arch}")
-        except ErrorReturnCode_1:
-            pass
+        dockerfile, target = self.image_source("client", client_arch)
+        return self.build_image(
+            self.client_image_tag(version, client_arch),
+            dockerfile,
+            "client",
+            client_arch,
+            push=push,
+            force=force,
+            stream_context=stream_context,
+            prefetcher=prefetcher,
+            cache=cache,
+            target=target,
+        )
+
+    def image_source(self, container_type, arch):
+        # The Dockerfile and build stage of an image
+        if container_type == "host":
+            return self.out_path / f"host/Dockerfile.{arch_slug(arch)}", None
+        return self.client_dockerfile_path, self.client_stage(arch)
+
+    def build_journaled(
+        self, container_type, arch, image, build, run, push=False, resume=False, retry=0, retry_delay=10
+    ):
+        """Run build, which returns the image's inputs digest, recording each
+        attempt in the build journal. Failed attempts are retried up to retry
+        times with exponential backoff. With resume, the build is skipped if
+        the journal's last success for image had the same inputs."""
+        if resume:
+            last = build_journal.last_success(image)
+            dockerfile, target = self.image_source(container_type, arch)
+            if last is not None and (last["pushed"] or not push):
+                digest = self.build_inputs_digest(dockerfile, container_type, arch, target=target)
+                if digest is not None and digest == last["inputs_digest"] and local_image(image) is not None:
+                    print(f"{image} is unchanged since run {last['run']}, skipping")
+                    build_journal.record(
+                        run=run,
+                        distro=self.name,
+                        container_type=container_type,
+                        arch=arch,
+                        image=image,
+                        attempt=0,
+                        status=BuildJournal.RESUMED,
+                        inputs_digest=digest,
+                        image_id=last["image_id"],
+                        pushed=last["pushed"],
+                        started=time.time(),
+                        seconds=0,
+                        error=None,
+                    )
+                    return digest
 
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.time()
+            digest = error = None
+            try:
+                digest = build()
+            except Exception as e:
+                error = e
+            seconds = time.time() - started
+            local = local_image(image) if error is None else None
+            build_journal.record(
+                run=run,
+                distro=self.name,
+                container_type=container_type,
+                arch=arch,
+                image=image,
+                attempt=attempt,
+                status=BuildJournal.SUCCEEDED if error is None else BuildJournal.FAILED,
+                inputs_digest=digest,
+                image_id=local["Id"] if local else None,
+                pushed=push and error is None,
+                started=started,
+                seconds=seconds,
+                error=repr(error) if error is not None else None,
+            )
+            if error is None:
+                return digest
+            if attempt > retry:
+                raise error
+            delay = retry_delay * 2 ** (attempt - 1)
+            print(f"Attempt {attempt} of {image} failed ({error!r}), retrying in {delay}s", file=sys.stderr)
+            time.sleep(delay)
+
+    def build_inputs_digest(self, dockerfile, container_type, arch, target=None):
+        base_image = self.from_image(arch)
+        base_digest = resolve_image_digest(base_image, arch)
+        if base_digest is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(f"platform linux/{arch}\n".encode())
+        digest.update(f"base {base_image}@{base_digest}\n".encode())
+        if target is not None:
+            digest.update(f"target {target}\n".encode())
+        digest.update(f"dockerfile {file_digest(PROJECT_DIR / dockerfile)}\n".encode())
+        for arcname, path in self.build_context_files(container_type):
+            path = PROJECT_DIR / path
+            # COPY preserves the executable bit, so it is part of the input
+            mode = 0o755 if os.access(path, os.X_OK) else 0o644
+            digest.update(f"file {arcname} {mode:o} {file_digest(path)}\n".encode())
+        return digest.hexdigest()
+
+    def build_image(
+        self,
+        image,
+        dockerfile,
+        container_type,
+        arch,
+        push=False,
+        force=False,
+        stream_context=False,
+        prefetcher=None,
+        cache=None,
+        target=None,
+    ):
+        digest = self.build_inputs_digest(dockerfile, container_type, arch, target=target)
+        if digest is None:
+            print(f"Could not resolve inputs digest for {image}, building unconditionally")
+
+        def is_up_to_date():
+            return digest is not None and not force and image_inputs_digest(image) == digest
+
+        platform = f"linux/{arch}"
+        from_registry = False
+        base_key = None
+        if prefetcher is not None:
+            base_key = prefetcher.base_key(self.from_image(arch))
+            prefetcher.reached(*((base_key,) if base_key is not None else ()))
+            # The prefetch may replace the local image with the registry copy,
+            # so it has to finish before the local image is checked.
+            from_registry = prefetcher.wait(image, platform)
+
+        if is_up_to_date():
+            print(f"{image} is up to date (inputs digest {digest})")
+            pushed = from_registry or build_index.is_pushed(image, digest)
+        else:
+            if prefetcher is None:
+                try:
+                    with tracer.span("docker.pull", distro=self.name, arch=arch, image=image):
+                        docker_pull(image, platform=platform)
+                except (ErrorReturnCode_1, DockerAPIError, OSError, http.client.HTTPException):
+                    pass
+
+            # The registry copy was built from identical inputs, so it needs
+            # neither a rebuild nor a push.
+            pushed = is_up_to_date()
+            if pushed:
+                print(f"Pulled {image} is up to date (inputs digest {digest})")
+            else:
+                if base_key is not None:
+                    prefetcher.wait(*base_key)
+                if stream_context:
+                    # The tar context holds the Dockerfile too
+                    context_args = ("-", "--file", "Dockerfile")
+                    context_kwargs = dict(_in=self.build_context_tar(container_type, dockerfile))
+                else:
+                    context_args = (self.out_path / container_type / "build-context", "--file", dockerfile)
+                    context_kwargs = {}
+                if cache is not None:
+                    cache_from, cache_to = self.build_cache(container_type, arch, cache)
+                    build_args = ("buildx", "build", "--builder", buildx_builder(), "--load")
+                    cache_args = (*(("--cache-from", cache_from) if cache_from else ()), "--cache-to", cache_to)
+                else:
+                    build_args = ("build",)
+                    cache_args = ("--cache-from", image)
+                # Builds always go through the CLI, as the Dockerfiles need
+                # BuildKit, which the Engine API's classic builder isn't.
+                require_qemu(arch)
+                with tracer.span("docker.build", distro=self.name, arch=arch, image=image):
+                    docker(
+                        *build_args,
+                        *context_args,
+                        "--tag",
+                        image,
+                        *cache_args,
+                        *(("--target", target) if target is not None else ()),
+                        "--platform",
+                        f"linux/{arch}",
+                        "--progress",
+                        "plain",
+                        *(("--label", f"{INPUTS_DIGEST_LABEL}={digest}") if digest is not None else ()),
+                        **context_kwargs,
+                    )
+
+        if push and not pushed:
+            with tracer.span("docker.push", distro=self.name, arch=arch, image=image):
+                docker_push(image)
+            pushed = True
+
+        if digest is not None:
+            build_index.record(image, digest, pushed=pushed)
+        return digest
+
+    def test(self, client_arch, version, host_arch=None, ready_timeout=120):
+        with self.run_host(host_arch=host_arch, ready_timeout=ready_timeout):
+            self.test_client(client_arch, version, "-t")
+
+    def test_client(self, client_arch, version, *docker_args, **kwargs):
+        image = self.client_image_tag(version, client_arch)
+        require_qemu(client_arch)
         docker(
-            "build",
-            self.out_path / "client/build-context",
-            "--file",
-            dockerfile,
-            "--tag",
-            image,
-            "--cache-from",
-            image,
+            "run",
+            *docker_args,
             "--platform",
             f"linux/{client_arch}",
-            "--progress",
-            "plain",
+            image,
+            "sh",
+            "/scripts/build-cjson.sh",
+            **kwargs,
         )
-        if push:
-            docker("push", image)
 
-    def test(self, client_arch, version, host_arch=None):
-        with self.run_host(host_arch=host_arch):
-            image = self.client_image_tag(version, client_arch)
-            docker(
-                "run",
-                "-t",
-                "--platform",
-                f"linux/{client_arch}",
-                image,
-                "sh",
-                "/scripts/build-cjson.sh",
-            )
+    def test_matrix(self, version, host_arch=None, jobs=None, ready_timeout=120):
+        """Test every client arch a host arch provides compilers for, running
+        the client containers concurrently against a single host container."""
+        if host_arch is None:
+            host_arch = get_current_arch()
+        client_archs = self.compiler_archs_by_host_arch[host_arch]
 
-    def push_host_manifest(self, version):
-        os.environ["DOCKER_CLI_EXPERIMENTAL"] = "enabled"
+        def run(client_arch):
+            output = io.StringIO()
+            start = time.monotonic()
+            try:
+                self.test_client(client_arch, version, "--rm", _out=output, _err=output)
+                passed = True
+            except sh.ErrorReturnCode:
+                passed = False
+            result = TestResult(passed, time.monotonic() - start, output.getvalue())
+            # Print each client's output in one piece rather than interleaved
+            for line in result.output.splitlines():
+                print(f"[{client_arch}] {line}")
+            return result
+
+        with self.run_host(host_arch=host_arch, ready_timeout=ready_timeout):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(client_archs)) as executor:
+                results = dict(zip(client_archs, executor.map(run, client_archs)))
+
+        print(f"{self.name} clients tested against linux/{host_arch} host:")
+        for client_arch, result in results.items():
+            print(f"{'PASS' if result.passed else 'FAIL':>6} {client_arch:<10} {result.seconds:8.1f}s")
+        failed = [client_arch for client_arch, result in results.items() if not result.passed]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(results)} client archs failed: {', '.join(failed)}")
+        return results
+
+    def benchmark_client(self, client_arch, version, jobs, corpus=None, local=False):
+        docker_args = [
+            "--rm",
+            "--platform",
+            f"linux/{client_arch}",
+            # Mount the scripts so that benchmarks also run against published images
+            "--volume",
+            f"{PROJECT_DIR / 'shared-build-context/client/scripts'}:/benchmark:ro",
+        ]
+        if corpus is not None:
+            docker_args += ["--volume", f"{Path(corpus).abspath()}:/corpus:ro"]
+        if local:
+            # distcc compiles jobs for "localhost" locally, without distccd
+            docker_args += ["--env", "DISTCC_HOSTS=localhost"]
+
+        require_qemu(client_arch)
+        output = docker(
+            "run",
+            *docker_args,
+            self.client_image_tag(version, client_arch),
+            "sh",
+            "/benchmark/benchmark.sh",
+            str(jobs),
+            _out=None,
+        )
 
-        images = {}
-        for host_arch in self.host_archs:
-            image = self.host_image_tag(version, host_arch)
-            images[host_arch] = image
-            docker("pull", image)
+        latencies = []
+        errors = 0
+        wall_seconds = None
+        for line in str(output).splitlines():
+            fields = line.split()
+            if fields[:1] == ["job"]:
+                # /proc/uptime has centisecond resolution
+                latencies.append(round(float(fields[2]) - float(fields[1]), 2))
+                errors += fields[3] != "0"
+            elif fields[:1] == ["total"]:
+                wall_seconds = round(float(fields[2]) - float(fields[1]), 2)
+        if wall_seconds is None:
+            raise RuntimeError(f"No benchmark results from {client_arch} client:\n{output}")
+        return latencies, errors, wall_seconds
+
+    def benchmark(self, version, host_arch=None, client_archs=None, job_levels=(1, 2, 4, 8), corpus=None):
+        """Benchmark distcc throughput of each client arch against a host arch
+        at each -j level, compared to compiling locally in the client."""
+        if host_arch is None:
+            host_arch = get_current_arch()
+        if not client_archs:
+            client_archs = self.compiler_archs_by_host_arch[host_arch]
 
-        for manifest in self.host_manifest_tags(version):
-            try:
-                docker("manifest", "create", "--amend", manifest, *images.values())
-            except ErrorReturnCode_1:
-                docker("manifest", "create", manifest, *images.values())
+        results = []
+        with self.run_host(host_arch=host_arch):
+            allocation = self.host_job_allocation(host_arch)
+            for client_arch in client_archs:
+                for jobs in job_levels:
+                    latencies, errors, wall_seconds = self.benchmark_client(client_arch, version, jobs, corpus=corpus)
+                    _, _, local_wall_seconds = self.benchmark_client(
+                        client_arch, version, jobs, corpus=corpus, local=True
+                    )
+                    results.append(
+                        dict(
+                            distro=self.name,
+                            host_arch=host_arch,
+                            compiler_arch=client_arch,
+                            jobs=jobs,
+                            host_jobs=allocation.get(client_arch),
+                            compile_jobs=len(latencies),
+                            errors=errors,
+                            wall_seconds=wall_seconds,
+                            jobs_per_second=round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+                            latency_p50_seconds=percentile(latencies, 50),
+                            latency_p95_seconds=percentile(latencies, 95),
+                            local_wall_seconds=local_wall_seconds,
+                            speedup=round(local_wall_seconds / wall_seconds, 3) if wall_seconds else None,
+                        )
+                    )
 
-            for host_arch in self.host_archs:
-                docker(
-                    "manifest",
-                    "annotate",
-                    manifest,
-                    images[host_arch],
-                    "--os",
-                    "linux",
-                    *docker_manifest_args[host_arch],
-                )
+        print(f"{self.name} distcc benchmark against linux/{host_arch} host:")
+        print(f"{'client':<10} {'-j':>3} {'slots':>5} {'jobs/s':>8} {'p50':>7} {'p95':>7} {'errors':>6} {'speedup':>7}")
+        for result in results:
+            print(
+                f"{result['compiler_arch']:<10} {result['jobs']:>3} {result['host_jobs'] or '-':>5}"
+                f" {result['jobs_per_second'] or 0:>8.2f}"
+                f" {result['latency_p50_seconds'] or 0:>6.2f}s {result['latency_p95_seconds'] or 0:>6.2f}s"
+                f" {result['errors']:>6} {result['speedup'] or 0:>6.2f}x"
+            )
+        return results
+
+    def loadtest_port(self, port, concurrency, duration, source=LOADTEST_SOURCE):
+        """Keep `concurrency` compile jobs in flight against a distccd port
+        for `duration` seconds. Returns the latency of each successful job, the
+        count of each kind of failure, and the seconds until all jobs finished."""
+        start = time.monotonic()
+        deadline = start + duration
+        lock = threading.Lock()
+        latencies = []
+        errors = collections.Counter()
+
+        def worker():
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                try:
+                    result = distcc_compile("127.0.0.1", port, source=source)
+                    error = f"status {result.status}" if result.status else None
+                except (OSError, DistccProtocolError) as e:
+                    error = e.__class__.__name__
+                with lock:
+                    if error is None:
+                        latencies.append(time.monotonic() - start)
+                    else:
+                        errors[error] += 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        return latencies, errors, time.monotonic() - start
+
+    def loadtest(
+        self,
+        host_arch=None,
+        compiler_archs=None,
+        concurrency_levels=(1, 2, 4, 8, 16, 32),
+        duration=10,
+        saturation=0.05,
+        ready_timeout=120,
+    ):
+        """Load test each compiler arch's distccd of a host container at rising
+        concurrency, until throughput improves by less than `saturation` or
+        jobs start failing."""
+        if host_arch is None:
+            host_arch = get_current_arch()
+        if not compiler_archs:
+            compiler_archs = self.compiler_archs_by_host_arch[host_arch]
+
+        results = []
+        with self.run_host(host_arch=host_arch, ready_timeout=ready_timeout):
+            for compiler_arch in compiler_archs:
+                port = int(self.ports_by_arch[compiler_arch])
+                best_jobs_per_second = 0
+                for concurrency in concurrency_levels:
+                    with tracer.span("loadtest", distro=self.name, arch=compiler_arch, concurrency=concurrency):
+                        latencies, errors, seconds = self.loadtest_port(port, concurrency, duration)
+                    jobs = len(latencies) + sum(errors.values())
+                    # Jobs in flight at the deadline finish after it, so count until they do
+                    jobs_per_second = round(len(latencies) / seconds, 3)
+                    result = dict(
+                        distro=self.name,
+                        host_arch=host_arch,
+                        compiler_arch=compiler_arch,
+                        concurrency=concurrency,
+                        jobs=jobs,
+                        errors=dict(errors),
+                        error_rate=round(sum(errors.values()) / jobs, 3) if jobs else None,
+                        jobs_per_second=jobs_per_second,
+                        latency_p50_seconds=percentile(latencies, 50),
+                        latency_p95_seconds=percentile(latencies, 95),
+                        latency_p99_seconds=percentile(latencies, 99),
+                        saturated=bool(errors) or jobs_per_second < best_jobs_per_second * (1 + saturation),
+                    )
+                    results.append(result)
+                    print(
+                        f"{compiler_arch} x{concurrency}: {jobs_per_second:.2f} jobs/s,"
+                        f" {sum(errors.values())} errors of {jobs} jobs"
+                    )
+                    if result["saturated"]:
+                        break
+                    best_jobs_per_second = jobs_per_second
+
+        print(f"{self.name} distccd load test of linux/{host_arch} host:")
+        print(f"{'compiler':<10} {'conc':>4} {'jobs/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'errors':>6}")
+        for result in results:
+            print(
+                f"{result['compiler_arch']:<10} {result['concurrency']:>4} {result['jobs_per_second']:>8.2f}"
+                f" {result['latency_p50_seconds'] or 0:>6.3f}s {result['latency_p95_seconds'] or 0:>6.3f}s"
+                f" {result['latency_p99_seconds'] or 0:>6.3f}s {result['error_rate'] or 0:>6.1%}"
+                + ("  saturated" if result["saturated"] else "")
+            )
+        return results
 
-            docker("manifest", "push", manifest)
+    def push_host_manifest(self, version):
+        images = {host_arch: self.host_image_tag(version, host_arch) for host_arch in self.host_archs}
+        self.push_manifest(self.host_manifest_tags(version), images)
 
     def push_client_manifest(self, version):
-        os.environ["DOCKER_CLI_EXPERIMENTAL"] = "enabled"
-
         images = {compiler_arch: self.client_image_tag(version, compiler_arch) for compiler_arch in self.compiler_archs}
+        self.push_manifest(self.client_manifest_tags(version), images)
 
-        for image in images.values():
-            docker("pull", image)
+    def push_manifest(self, manifest_tags, images):
+        # Assemble the manifest lists from registry metadata, falling back to
+        # pulling each image and `docker manifest`, which can use credential
+        # helpers and copy blobs across registries.
+        try:
+            with tracer.span("manifest.registry", distro=self.name):
+                registry_client.push_manifest_list(manifest_tags, images)
+            return
+        except (RegistryError, OSError, http.client.HTTPException) as e:
+            print(f"Could not push manifest lists via the registry API ({e}), falling back to docker manifest")
 
-        for manifest in self.client_manifest_tags(version):
-            try:
-                docker("manifest", "create", "--amend", manifest, *images.values())
-            except ErrorReturnCode_1:
-                docker("manifest", "create", manifest, *images.values())
+        os.environ["DOCKER_CLI_EXPERIMENTAL"] = "enabled"
 
-            for compiler_arch in self.compiler_archs:
-                docker(
-                    "manifest",
-                    "annotate",
-                    manifest,
-                    images[compiler_arch],
-                    "--os",
-                    "linux",
-                    *docker_manifest_args[compiler_arch],
-                )
+        for arch, image in images.items():
+            with tracer.span("docker.pull", distro=self.name, arch=arch, image=image):
+                docker_pull(image)
+
+        for manifest in manifest_tags:
+            with tracer.span("manifest.create", distro=self.name, manifest=manifest):
+                try:
+                    docker("manifest", "create", "--amend", manifest, *images.values())
+                except ErrorReturnCode_1:
+                    docker("manifest", "create", manifest, *images.values())
+
+            for arch, image in images.items():
+                with tracer.span("manifest.annotate", distro=self.name, arch=arch, manifest=manifest):
+                    docker(
+                        "manifest",
+                        "annotate",
+                        manifest,
+                        image,
+                        "--os",
+                        "linux",
+                        *docker_manifest_args[arch],
+                    )
 
-            docker("manifest", "push", manifest)
+            with tracer.span("manifest.push", distro=self.name, manifest=manifest):
+                docker("manifest", "push", manifest)
+
+    def ccache_stats(self, version, compiler_archs=None):
+        """Print the hits and misses of the host and client ccache volumes of
+        each compiler arch, using the client image of the current arch."""
+        current_arch = get_current_arch()
+        if current_arch not in self.compiler_archs:
+            raise ValueError(f"{self.name} has no linux/{current_arch} client image to read ccache stats with")
+        volume_args = []
+        cache_dirs = []
+        for compiler_arch in compiler_archs or self.compiler_archs:
+            for container_type in ("host", "client"):
+                cache_dir = f"/ccache/{container_type}/{arch_slug(compiler_arch)}"
+                volume_args += ["--volume", f"{self.ccache_volume(container_type, compiler_arch)}:{cache_dir}"]
+                cache_dirs.append(cache_dir)
+        docker(
+            "run",
+            "--rm",
+            *volume_args,
+            self.client_image_tag(version, current_arch),
+            "sh",
+            "-c",
+            'for dir; do echo "$dir:"; CCACHE_DIR="$dir" ccache --show-stats; done',
+            "sh",
+            *cache_dirs,
+        )
+
+    def host_job_allocation(self, host_arch):
+        """Return the distccd job slots per compiler arch of a running host container."""
+        output = docker_compose(
+            "-f",
+            self.docker_compose_yml_path,
+            "exec",
+            "-T",
+            f"host-{arch_slug(host_arch)}",
+            "cat",
+            DISTCC_ALLOCATION_PATH,
+        )
+        return parse_job_allocation(str(output))
 
     @contextlib.contextmanager
-    def run_host(self, host_arch=None):
+    def run_host(self, host_arch=None, ready_timeout=120):
         if host_arch is None:
             host_arch = get_current_arch()
 
         service_name = f"host-{arch_slug(host_arch)}"
 
-        def image_id():
-            return docker(
-                "ps",
-                "--filter",
-                f"name={service_name}",
-                "--format",
-                "{{.ID}}",
-                _out=None,
-                _err=None,
-            ).strip()
-
-        id = image_id()
-        if id:
-            docker("kill", id, _out=None, _err=None)
-        docker_compose("-f", self.docker_compose_yml_path, "up", "-d", service_name)
-        time.sleep(5)
+        for id in docker_container_ids(service_name):
+            docker_kill(id)
+        require_qemu(host_arch)
         try:
-            yield
+            with tracer.span("host.startup", distro=self.name, arch=host_arch):
+                docker_compose("-f", self.docker_compose_yml_path, "up", "-d", service_name)
+                ports = [int(self.ports_by_arch[arch]) for arch in self.compiler_archs_by_host_arch[host_arch]]
+                ready = wait_for_distccd(ports, timeout=ready_timeout)
+            yield ready
         finally:
-            id = image_id()
-            if id:
-                docker("kill", id, _out=None, _err=None)
+            for id in docker_container_ids(service_name):
+                docker_kill(id)
 
 
 class DebianLike(Distro):
@@ -632,6 +2776,7 @@ class DebianLike(Distro):
         "ppc64le": "3610",
         "mips64le": "3611",
     }
+    metrics_port = "3600"
     toolchains_by_arch = {
         "amd64": "x86_64-linux-gnu",
         "386": "i686-linux-gnu",
@@ -643,10 +2788,6 @@ class DebianLike(Distro):
         "mips64le": "mipsel-linux-gnu",
     }
 
-    def __init__(self, **kwargs):
-        super(DebianLike, self).__init__(**kwargs)
-        self.env.filters["apt_pkgs"] = self.get_apt_pkgs
-
     def get_apt_pkgs(self, host_arch):
         pkgs = "build-essential g++ distcc lsb-base"
         for compiler_arch in self.compiler_archs_by_host_arch[host_arch]:
@@ -660,6 +2801,9 @@ class DebianLike(Distro):
 
 
 class XtoolsDistro(Distro):
+    # Extracts the toolchains on the build platform in cross-build mode
+    toolchain_extract_image = "alpine:3.15"
+
     @property
     @abc.abstractmethod
     def xtools_release(self):
@@ -720,6 +2864,7 @@ class ArchLinuxLike(XtoolsDistro):
         "arm/v7": "3707",
         "arm64/v8": "3708",
     }
+    metrics_port = "3700"
     toolchains_by_arch = {
         "amd64": "x86_64-build_pc-linux-gnu",
         "arm/v5": "armv5tel-unknown-linux-gnueabi",
@@ -769,6 +2914,7 @@ class AlpineLike(XtoolsDistro):
         "arm64/v8": "3808",
         "ppc64le": "3810",
     }
+    metrics_port = "3800"
     toolchains_by_arch = {
         "386": "i586-alpine-linux-musl",
         "amd64": "x86_64-alpine-linux-musl",
@@ -795,26 +2941,139 @@ alpine_3_15 = AlpineLike(
 
 
 def render_readme():
-    env = Environment(autoescape=False, undefined=StrictUndefined)
-    env.filters["slugify"] = slugify
-    env.filters["arch_slug"] = arch_slug
-    with PROJECT_DIR:
-        context = dict(
-            project_name="build-farm",
-            repo="elijahr/build-farm",
-            Distro=Distro,
-        )
-        for distro in Distro.registry.values():
-            context[distro.identifier] = distro
-        with open("README.md.jinja", "r") as f:
-            rendered = env.from_string(f.read()).render(**context)
-        with open("README.md", "w") as f:
-            f.write(rendered)
-        print("Rendered README.md.jinja -> README.md")
+    context = dict(
+        project_name="build-farm",
+        repo="elijahr/build-farm",
+        Distro=Distro,
+    )
+    for distro in Distro.registry.values():
+        context[distro.identifier] = distro
+    rendered = get_template_env().render_template("README.md.jinja", **context)
+    with open(PROJECT_DIR / "README.md", "w") as f:
+        f.write(rendered)
+    print("Rendered README.md.jinja -> README.md")
+
+
+def render_bake(
+    version, distros=None, cache=None, cross_build=False, ccache=False, pump=False, metrics=False, inventory=None
+):
+    """Render docker-bake.hcl, a buildx bake file with a target per image and
+    a group per distro, after rendering the trees its targets build."""
+    if distros is None:
+        distros = list(Distro.registry.values())
+    Distro.render_many(
+        distros,
+        version=version,
+        cross_build=cross_build,
+        ccache=ccache,
+        pump=pump,
+        metrics=metrics,
+        inventory=inventory,
+    )
+    rendered = get_template_env().render_template(
+        "docker-bake.hcl.jinja",
+        distros=distros,
+        version=version,
+        cache=cache,
+    )
+    with open(PROJECT_DIR / "docker-bake.hcl", "w") as f:
+        f.write(rendered)
+    print("Rendered docker-bake.hcl.jinja -> docker-bake.hcl")
+    return distros
+
+
+def build_bake(
+    version,
+    distros=None,
+    push=False,
+    cache=None,
+    cross_build=False,
+    ccache=False,
+    pump=False,
+    metrics=False,
+    inventory=None,
+):
+    """Build the images of distros with a single `docker buildx bake`, which
+    lets BuildKit schedule them concurrently and share base stages."""
+    distros = render_bake(
+        version,
+        distros=distros,
+        cache=cache,
+        cross_build=cross_build,
+        ccache=ccache,
+        pump=pump,
+        metrics=metrics,
+        inventory=inventory,
+    )
+    docker(
+        "buildx",
+        "bake",
+        *(("--builder", buildx_builder()) if cache is not None else ()),
+        "--file",
+        "docker-bake.hcl",
+        "--progress",
+        "plain",
+        "--push" if push else "--load",
+        *(distro.bake_group for distro in distros),
+        _cwd=PROJECT_DIR,
+    )
+
+
+def load_inventory(path):
+    """Load the hosts of a farm inventory, a YAML file such as:
+
+    hosts:
+      - address: build-host1
+        distro: archlinux
+        arch: amd64
+        jobs: 16
+        weights: {arm/v7: 2}
+
+    where jobs, the host's job slots, and weights, per compiler arch, are optional.
+    """
+    with open(path) as f:
+        inventory = yaml.load(f, Loader=yaml.SafeLoader) or {}
+    hosts = inventory.get("hosts") or []
+    for host in hosts:
+        missing = {"address", "distro", "arch"} - set(host)
+        if missing:
+            raise ValueError(f"Inventory host {host!r} is missing {', '.join(sorted(missing))}")
+        Distro.get(host["distro"])
+    return hosts
+
+
+def write_distcc_hosts(inventory, distros=None, out_dir=None, pump=False):
+    """Print the DISTCC_HOSTS of each distro and compiler arch in an inventory,
+    and optionally write them to env files for `docker run --env-file`."""
+    if distros is None:
+        distros = list(Distro.registry.values())
+    for distro in distros:
+        for compiler_arch, distcc_hosts in distro.distcc_hosts(inventory, pump=pump).items():
+            print(f"{distro.name} linux/{compiler_arch}: DISTCC_HOSTS={shlex.quote(distcc_hosts)}")
+            if out_dir is not None:
+                out_path = Path(out_dir) / f"{distro.slug}-{arch_slug(compiler_arch)}.env"
+                os.makedirs(out_dir, exist_ok=True)
+                with open(out_path, "w") as f:
+                    f.write(f"DISTCC_HOSTS={distcc_hosts}\n")
+
+
+def non_negative_int(value):
+    value = int(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return value
+
+
+INVENTORY_HELP = "farm inventory YAML, to set the clients' DISTCC_HOSTS from"
+CCACHE_HELP = "serve repeated compiles from ccache volumes, in both the host and the client containers"
+PUMP_HELP = "use distcc pump mode, which preprocesses on the hosts rather than in the clients"
+METRICS_HELP = "serve Prometheus metrics of the hosts' distccd daemons"
+CROSS_BUILD_HELP = "run the Dockerfile steps that don't need the target arch, e.g. toolchain extraction, natively"
 
 
 def make_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON file of the run's phases")
 
     subparsers = parser.add_subparsers(dest="subcommand")
 
@@ -832,16 +3091,55 @@ def make_parser():
     # render
     parser_render = subparsers.add_parser("render")
     parser_render.add_argument("--version", required=True)
+    parser_render.add_argument("--jobs", type=int, default=1)
+    parser_render.add_argument("--no-copy-build-contexts", dest="copy_build_contexts", action="store_false")
+    parser_render.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_render.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_render.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_render.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_render.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
 
     # render
     subparsers.add_parser("render-github-actions")
 
+    # render-bake
+    parser_render_bake = subparsers.add_parser("render-bake")
+    parser_render_bake.add_argument("--version", required=True)
+    parser_render_bake.add_argument("--distro", dest="distros", type=Distro.get, action="append")
+    parser_render_bake.add_argument("--cache", choices=BUILD_CACHE_TYPES, help="BuildKit cache to import and export")
+    parser_render_bake.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_render_bake.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_render_bake.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_render_bake.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_render_bake.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
+
+    # build-bake
+    parser_build_bake = subparsers.add_parser("build-bake")
+    parser_build_bake.add_argument("--version", required=True)
+    parser_build_bake.add_argument("--distro", dest="distros", type=Distro.get, action="append")
+    parser_build_bake.add_argument("--cache", choices=BUILD_CACHE_TYPES, help="BuildKit cache to import and export")
+    parser_build_bake.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_build_bake.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_build_bake.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_build_bake.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_build_bake.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
+    parser_build_bake.add_argument("--push", action="store_true")
+
     # build-host
     parser_build_host = subparsers.add_parser("build-host")
     parser_build_host.add_argument("--distro", type=Distro.get, required=True)
     parser_build_host.add_argument("--arch", required=True)
     parser_build_host.add_argument("--version", required=True)
     parser_build_host.add_argument("--push", action="store_true")
+    parser_build_host.add_argument("--no-render", dest="render", action="store_false")
+    parser_build_host.add_argument("--force", action="store_true")
+    parser_build_host.add_argument("--stream-context", action="store_true")
+    parser_build_host.add_argument("--cache", choices=BUILD_CACHE_TYPES, help="BuildKit cache to import and export")
+    parser_build_host.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_build_host.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_build_host.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_build_host.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_build_host.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
 
     # build-client
     parser_build_client = subparsers.add_parser("build-client")
@@ -849,11 +3147,49 @@ def make_parser():
     parser_build_client.add_argument("--arch", required=True)
     parser_build_client.add_argument("--version", required=True)
     parser_build_client.add_argument("--push", action="store_true")
+    parser_build_client.add_argument("--no-render", dest="render", action="store_false")
+    parser_build_client.add_argument("--force", action="store_true")
+    parser_build_client.add_argument("--stream-context", action="store_true")
+    parser_build_client.add_argument("--cache", choices=BUILD_CACHE_TYPES, help="BuildKit cache to import and export")
+    parser_build_client.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_build_client.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_build_client.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_build_client.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_build_client.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
 
     # build-all
     parser_build_all = subparsers.add_parser("build-all")
     parser_build_all.add_argument("--version", required=True)
     parser_build_all.add_argument("--push", action="store_true")
+    parser_build_all.add_argument("--jobs", type=int, default=1)
+    parser_build_all.add_argument("--native-jobs", type=int)
+    parser_build_all.add_argument("--emulated-jobs", type=int)
+    parser_build_all.add_argument("--force", action="store_true")
+    parser_build_all.add_argument("--stream-context", action="store_true")
+    parser_build_all.add_argument("--cache", choices=BUILD_CACHE_TYPES, help="BuildKit cache to import and export")
+    parser_build_all.add_argument("--cross-build", action="store_true", help=CROSS_BUILD_HELP)
+    parser_build_all.add_argument("--ccache", action="store_true", help=CCACHE_HELP)
+    parser_build_all.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_build_all.add_argument("--metrics", action="store_true", help=METRICS_HELP)
+    parser_build_all.add_argument("--inventory", type=load_inventory, help=INVENTORY_HELP)
+    parser_build_all.add_argument(
+        "--prefetch",
+        type=non_negative_int,
+        default=2,
+        help="number of images to pull ahead of the builds, 0 to pull before each build",
+    )
+    parser_build_all.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip targets whose last success in the build journal had the same inputs",
+    )
+    parser_build_all.add_argument("--retry", type=int, default=0, help="times to retry a failed target")
+    parser_build_all.add_argument(
+        "--retry-delay",
+        type=float,
+        default=10,
+        help="seconds before the first retry, doubling for each one after it",
+    )
 
     # clean
     subparsers.add_parser("clean")
@@ -864,6 +3200,51 @@ def make_parser():
     parser_test.add_argument("--host-arch")
     parser_test.add_argument("--client-arch", required=True)
     parser_test.add_argument("--version", required=True)
+    parser_test.add_argument("--ready-timeout", type=float, default=120)
+
+    # test-matrix
+    parser_test_matrix = subparsers.add_parser("test-matrix")
+    parser_test_matrix.add_argument("--distro", type=Distro.get, required=True)
+    parser_test_matrix.add_argument("--host-arch")
+    parser_test_matrix.add_argument("--version", required=True)
+    parser_test_matrix.add_argument("--jobs", type=int)
+    parser_test_matrix.add_argument("--ready-timeout", type=float, default=120)
+
+    # benchmark
+    parser_benchmark = subparsers.add_parser("benchmark")
+    parser_benchmark.add_argument("--distro", type=Distro.get, required=True)
+    parser_benchmark.add_argument("--host-arch")
+    parser_benchmark.add_argument("--client-arch", dest="client_archs", action="append")
+    parser_benchmark.add_argument("--version", required=True)
+    parser_benchmark.add_argument(
+        "--jobs",
+        type=lambda value: tuple(int(jobs) for jobs in value.split(",")),
+        default=(1, 2, 4, 8),
+        help="comma separated -j levels",
+    )
+    parser_benchmark.add_argument("--corpus", help="directory of C/C++ sources, defaults to cJSON")
+    parser_benchmark.add_argument("--output", help="write results as JSON to this file")
+
+    # loadtest
+    parser_loadtest = subparsers.add_parser("loadtest")
+    parser_loadtest.add_argument("--distro", type=Distro.get, required=True)
+    parser_loadtest.add_argument("--host-arch")
+    parser_loadtest.add_argument("--compiler-arch", dest="compiler_archs", action="append")
+    parser_loadtest.add_argument(
+        "--concurrency",
+        type=lambda value: tuple(int(concurrency) for concurrency in value.split(",")),
+        default=(1, 2, 4, 8, 16, 32),
+        help="comma separated concurrency levels, ramped through until saturation",
+    )
+    parser_loadtest.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser_loadtest.add_argument(
+        "--saturation",
+        type=float,
+        default=0.05,
+        help="stop ramping once throughput improves by less than this fraction",
+    )
+    parser_loadtest.add_argument("--ready-timeout", type=float, default=120)
+    parser_loadtest.add_argument("--output", help="write results as JSON to this file")
 
     # push-host-manifest
     parser_push_host_manifest = subparsers.add_parser("push-host-manifest")
@@ -881,11 +3262,49 @@ def make_parser():
     # configure-qemu
     subparsers.add_parser("configure-qemu")
 
+    # ccache-stats
+    parser_ccache_stats = subparsers.add_parser("ccache-stats")
+    parser_ccache_stats.add_argument("--distro", type=Distro.get, required=True)
+    parser_ccache_stats.add_argument("--version", required=True)
+    parser_ccache_stats.add_argument("--arch", dest="archs", action="append")
+
+    # distcc-hosts
+    parser_distcc_hosts = subparsers.add_parser("distcc-hosts")
+    parser_distcc_hosts.add_argument("--inventory", type=load_inventory, required=True, help=INVENTORY_HELP)
+    parser_distcc_hosts.add_argument("--distro", dest="distros", type=Distro.get, action="append")
+    parser_distcc_hosts.add_argument("--pump", action="store_true", help=PUMP_HELP)
+    parser_distcc_hosts.add_argument("--out-dir", help="write a <distro>-<arch>.env file per compiler arch here")
+
+    # journal
+    parser_journal = subparsers.add_parser("journal")
+    parser_journal.add_argument("--distro", type=Distro.get)
+    parser_journal.add_argument("--arch")
+    parser_journal.add_argument("--container-type", choices=("host", "client"))
+    parser_journal.add_argument(
+        "--status",
+        choices=(BuildJournal.SUCCEEDED, BuildJournal.FAILED, BuildJournal.RESUMED),
+    )
+    parser_journal.add_argument("--limit", type=int, default=50)
+    parser_journal.add_argument(
+        "--durations",
+        action="store_true",
+        help="print per image build duration statistics instead of the latest attempts",
+    )
+
     return parser
 
 
 def main():
     args = make_parser().parse_args()
+    try:
+        run_subcommand(args)
+    finally:
+        tracer.print_summary()
+        if args.trace:
+            tracer.export(args.trace)
+
+
+def run_subcommand(args):
     if args.subcommand == "list-distros":
         print("\n".join(Distro.registry.keys()))
 
@@ -896,26 +3315,144 @@ def main():
         print("\n".join(args.distro.compiler_archs))
 
     elif args.subcommand == "render":
-        Distro.render_all(version=args.version)
+        Distro.render_all(
+            jobs=args.jobs,
+            copy_build_contexts=args.copy_build_contexts,
+            version=args.version,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+        )
 
     elif args.subcommand == "render-github-actions":
         for distro in Distro.registry.values():
             distro.render_github_actions()
 
+    elif args.subcommand == "render-bake":
+        render_bake(
+            version=args.version,
+            distros=args.distros,
+            cache=args.cache,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+        )
+
+    elif args.subcommand == "build-bake":
+        build_bake(
+            version=args.version,
+            distros=args.distros,
+            push=args.push,
+            cache=args.cache,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+        )
+
     elif args.subcommand == "build-host":
-        args.distro.build_host(args.arch, version=args.version, push=args.push)
+        args.distro.build_host(
+            args.arch,
+            version=args.version,
+            push=args.push,
+            render=args.render,
+            force=args.force,
+            stream_context=args.stream_context,
+            cache=args.cache,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+        )
 
     elif args.subcommand == "build-client":
-        args.distro.build_client(args.arch, version=args.version, push=args.push)
+        args.distro.build_client(
+            args.arch,
+            version=args.version,
+            push=args.push,
+            render=args.render,
+            force=args.force,
+            stream_context=args.stream_context,
+            cache=args.cache,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+        )
 
     elif args.subcommand == "build-all":
-        Distro.build_all(version=args.version, push=args.push)
+        Distro.build_all(
+            version=args.version,
+            push=args.push,
+            jobs=args.jobs,
+            native_jobs=args.native_jobs,
+            emulated_jobs=args.emulated_jobs,
+            force=args.force,
+            stream_context=args.stream_context,
+            prefetch=args.prefetch,
+            cache=args.cache,
+            cross_build=args.cross_build,
+            ccache=args.ccache,
+            pump=args.pump,
+            metrics=args.metrics,
+            inventory=args.inventory,
+            resume=args.resume,
+            retry=args.retry,
+            retry_delay=args.retry_delay,
+        )
 
     elif args.subcommand == "clean":
         Distro.clean_all()
 
     elif args.subcommand == "test":
-        args.distro.test(host_arch=args.host_arch, client_arch=args.client_arch, version=args.version)
+        args.distro.test(
+            host_arch=args.host_arch,
+            client_arch=args.client_arch,
+            version=args.version,
+            ready_timeout=args.ready_timeout,
+        )
+
+    elif args.subcommand == "test-matrix":
+        args.distro.test_matrix(
+            host_arch=args.host_arch,
+            version=args.version,
+            jobs=args.jobs,
+            ready_timeout=args.ready_timeout,
+        )
+
+    elif args.subcommand == "benchmark":
+        results = args.distro.benchmark(
+            host_arch=args.host_arch,
+            client_archs=args.client_archs,
+            version=args.version,
+            job_levels=args.jobs,
+            corpus=args.corpus,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(dict(version=args.version, timestamp=time.time(), results=results), f, indent=2)
+            print(f"Wrote {args.output}")
+
+    elif args.subcommand == "loadtest":
+        results = args.distro.loadtest(
+            host_arch=args.host_arch,
+            compiler_archs=args.compiler_archs,
+            concurrency_levels=args.concurrency,
+            duration=args.duration,
+            saturation=args.saturation,
+            ready_timeout=args.ready_timeout,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(dict(timestamp=time.time(), results=results), f, indent=2)
+            print(f"Wrote {args.output}")
 
     elif args.subcommand == "push-host-manifest":
         args.distro.push_host_manifest(version=args.version)
@@ -929,6 +3466,34 @@ def main():
     elif args.subcommand == "configure-qemu":
         configure_qemu()
 
+    elif args.subcommand == "ccache-stats":
+        args.distro.ccache_stats(args.version, compiler_archs=args.archs)
+
+    elif args.subcommand == "distcc-hosts":
+        write_distcc_hosts(args.inventory, distros=args.distros, out_dir=args.out_dir, pump=args.pump)
+
+    elif args.subcommand == "journal":
+        filters = dict(
+            distro=args.distro.name if args.distro else None,
+            arch=args.arch,
+            container_type=args.container_type,
+            status=args.status,
+        )
+        if args.durations:
+            print(f"{'image':<72} {'status':>10} {'builds':>6} {'mean':>8} {'max':>8} {'last':>8}")
+            for row in build_journal.durations(**filters):
+                print(
+                    f"{row['image']:<72} {row['status']:>10} {row['builds']:>6}"
+                    f" {row['mean']:>7.1f}s {row['max']:>7.1f}s {row['last']:>7.1f}s"
+                )
+        else:
+            for row in reversed(build_journal.query(limit=args.limit, **filters)):
+                started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["started"]))
+                print(
+                    f"{started} {row['run']} {row['status']:>10} #{row['attempt']} {row['seconds']:>7.1f}s"
+                    f" {row['image']}{' ' + row['error'][:100] if row['error'] else ''}"
+                )
+
     else:
         raise ValueError(f"Unknown subcommand {args.subcommand}")
 
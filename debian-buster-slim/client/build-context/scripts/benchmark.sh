@@ -0,0 +1,56 @@
+#!/bin/sh
+
+# Compile every C/C++ source file of a corpus with up to $1 concurrent jobs,
+# using the compiler wrappers in PATH. Prints a "job <start> <end> <status>
+# <source>" line per compile and a "total <start> <end> <jobs>" line for the
+# whole run, with times in seconds since boot.
+#
+# The corpus is /corpus if mounted, otherwise the bundled cJSON sources.
+# Extra compiler flags can be passed via BENCHMARK_CFLAGS.
+
+set -ue
+
+JOBS=${1:-1}
+
+SCRIPT_DIR="$(
+  cd "$(dirname "$0")" >/dev/null 2>&1
+  pwd -P
+)"
+
+if [ -d /corpus ]; then
+  CORPUS=/corpus
+else
+  CORPUS=$(mktemp -d)
+  tar xzf "${SCRIPT_DIR}/cJSON-master.tar.gz" -C "$CORPUS"
+fi
+
+OUT_DIR=$(mktemp -d)
+INCLUDES=$(find "$CORPUS" -type f -name '*.h' -exec dirname {} \; | sort -u | sed 's/^/-I/' | tr '\n' ' ')
+BENCHMARK_CFLAGS=${BENCHMARK_CFLAGS:-}
+export OUT_DIR INCLUDES BENCHMARK_CFLAGS
+
+START=$(cut -d ' ' -f 1 /proc/uptime)
+
+# shellcheck disable=SC2016
+find "$CORPUS" -type f \( -name '*.c' -o -name '*.cc' -o -name '*.cpp' \) | sort | xargs -n 1 -P "$JOBS" sh -c '
+  src=$1
+  case $src in
+    *.c) compiler=cc ;;
+    *) compiler=g++ ;;
+  esac
+  obj="$OUT_DIR/$(echo "$src" | tr / _).o"
+  start=$(cut -d " " -f 1 /proc/uptime)
+  status=0
+  # shellcheck disable=SC2086
+  $compiler $INCLUDES $BENCHMARK_CFLAGS -c "$src" -o "$obj" 2>/dev/null || status=$?
+  end=$(cut -d " " -f 1 /proc/uptime)
+  echo "job $start $end $status $src"
+' sh
+
+END=$(cut -d ' ' -f 1 /proc/uptime)
+echo "total $START $END $JOBS"
+
+rm -Rf "$OUT_DIR"
+if [ "$CORPUS" != /corpus ]; then
+  rm -Rf "$CORPUS"
+fi
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""Serve the stats of the host's distccd daemons as Prometheus metrics.
+
+Usage: metrics-exporter.py PORT DISTRO HOST_ARCH COMPILER_ARCH=STATS_PORT...
+
+Each daemon's stats are read from its --stats-port on every scrape of
+http://<host>:PORT/metrics, and labelled by distro, host arch and compiler arch.
+"""
+
+import http.server
+import socket
+import sys
+
+# distccd stat -> (metric, type, help)
+METRICS = {
+    "dcc_tcp_accept": ("distccd_connections_total", "counter", "Connections accepted"),
+    "dcc_rej_bad_req": ("distccd_rejected_bad_request_total", "counter", "Requests rejected as malformed"),
+    "dcc_rej_overload": (
+        "distccd_rejected_overload_total",
+        "counter",
+        "Requests rejected while all job slots were busy",
+    ),
+    "dcc_compile_ok": ("distccd_compiles_succeeded_total", "counter", "Compiles that succeeded"),
+    "dcc_compile_error": ("distccd_compiles_failed_total", "counter", "Compiles that failed"),
+    "dcc_compile_timeout": ("distccd_compiles_timed_out_total", "counter", "Compiles that timed out"),
+    "dcc_cli_disconnect": ("distccd_client_disconnects_total", "counter", "Clients that disconnected mid-request"),
+    "dcc_other": ("distccd_other_errors_total", "counter", "Other errors"),
+    "dcc_current_load": ("distccd_active_jobs", "gauge", "Jobs being served"),
+    "dcc_max_kids": ("distccd_job_slots", "gauge", "Job slots, as set by --jobs"),
+    "dcc_num_procstate_D": ("distccd_jobs_blocked", "gauge", "Jobs in uninterruptible sleep, usually waiting on IO"),
+    "dcc_load1": ("distccd_load1", "gauge", "1 minute load average"),
+    "dcc_load2": ("distccd_load5", "gauge", "5 minute load average"),
+    "dcc_load3": ("distccd_load15", "gauge", "15 minute load average"),
+    "dcc_max_RSS": ("distccd_max_rss_kilobytes", "gauge", "Largest resident set size of a compiler"),
+    "dcc_free_space": ("distccd_free_space_megabytes", "gauge", "Free space in the temporary directory"),
+}
+
+
+def read_stats(port, timeout=2):
+    # distccd writes its stats and closes the connection, without a request
+    chunks = []
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    stats = {}
+    for line in b"".join(chunks).decode(errors="replace").splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] in METRICS:
+            try:
+                stats[fields[0]] = float(fields[1])
+            except ValueError:
+                pass
+    return stats
+
+
+def labels(**values):
+    return ",".join(
+        '{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in values.items()
+    )
+
+
+def render_metrics(distro, host_arch, stats_ports):
+    samples = {metric: [] for metric, _, _ in METRICS.values()}
+    up = []
+    for compiler_arch, port in stats_ports.items():
+        sample_labels = labels(distro=distro, host_arch=host_arch, compiler_arch=compiler_arch)
+        try:
+            stats = read_stats(port)
+        except OSError:
+            up.append(f"distccd_up{{{sample_labels}}} 0")
+            continue
+        up.append(f"distccd_up{{{sample_labels}}} 1")
+        for stat, value in stats.items():
+            samples[METRICS[stat][0]].append(f"{METRICS[stat][0]}{{{sample_labels}}} {value:g}")
+
+    lines = ["# HELP distccd_up Whether the daemon's stats could be read", "# TYPE distccd_up gauge", *up]
+    for metric, metric_type, help in METRICS.values():
+        if samples[metric]:
+            lines += [f"# HELP {metric} {help}", f"# TYPE {metric} {metric_type}", *samples[metric]]
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    port, distro, host_arch = int(sys.argv[1]), sys.argv[2], sys.argv[3]
+    stats_ports = {}
+    for arg in sys.argv[4:]:
+        compiler_arch, stats_port = arg.rsplit("=", 1)
+        stats_ports[compiler_arch] = int(stats_port)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics(distro, host_arch, stats_ports).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http.server.ThreadingHTTPServer(("0.0.0.0", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/bin/sh
+# Rendered from shared-build-context/host/scripts/run.sh.jinja
+
+
+export ORIGINAL_PATH="$PATH"
+
+# Split the host's job slots between the compiler archs by weight, so that a
+# host providing many toolchains doesn't accept many times more concurrent
+# compiles than it has CPUs or memory for. Overrides:
+#   DISTCC_TOTAL_JOBS          job slots shared by all compiler archs
+#   DISTCC_MEM_PER_JOB_MB      memory needed per job slot (default 256)
+#   DISTCC_WEIGHT_<ARCH_SLUG>  weight of a compiler arch, e.g. DISTCC_WEIGHT_ARM32V7
+#   DISTCC_JOBS_<ARCH_SLUG>    job slots of a compiler arch, ignoring weights
+#   DISTCC_NICE                niceness of the compile jobs (default 5)
+CPUS=$(nproc)
+MEM_AVAILABLE_KB=$(awk '/^MemAvailable:/ { print $2 }' /proc/meminfo)
+if [ -n "$MEM_AVAILABLE_KB" ]; then
+  MEM_JOBS=$((MEM_AVAILABLE_KB / 1024 / ${DISTCC_MEM_PER_JOB_MB:-256}))
+else
+  MEM_JOBS=$CPUS
+fi
+TOTAL_JOBS=${DISTCC_TOTAL_JOBS:-$((CPUS < MEM_JOBS ? CPUS : MEM_JOBS))}
+if [ "$TOTAL_JOBS" -lt 1 ]; then
+  TOTAL_JOBS=1
+fi
+NICE=${DISTCC_NICE:-5}
+
+WEIGHT_AMD64=${DISTCC_WEIGHT_AMD64:-1}
+WEIGHT_386=${DISTCC_WEIGHT_386:-1}
+WEIGHT_ARM32V5=${DISTCC_WEIGHT_ARM32V5:-1}
+WEIGHT_ARM32V7=${DISTCC_WEIGHT_ARM32V7:-1}
+WEIGHT_ARM64V8=${DISTCC_WEIGHT_ARM64V8:-1}
+WEIGHT_PPC64LE=${DISTCC_WEIGHT_PPC64LE:-1}
+WEIGHT_S390X=${DISTCC_WEIGHT_S390X:-1}
+WEIGHT_MIPS64LE=${DISTCC_WEIGHT_MIPS64LE:-1}
+TOTAL_WEIGHT=$((WEIGHT_AMD64 + WEIGHT_386 + WEIGHT_ARM32V5 + WEIGHT_ARM32V7 + WEIGHT_ARM64V8 + WEIGHT_PPC64LE + WEIGHT_S390X + WEIGHT_MIPS64LE))
+
+# /var/run/distccd/allocation lists "<compiler arch> <port> <jobs>" per
+# compiler arch. It is copied to /var/run/build-farm/allocations/<service>
+# when that directory is mounted, as the rendered docker-compose.yml does
+# with a volume the client containers mount too.
+ALLOCATION=/var/run/distccd/allocation
+SHARED_ALLOCATIONS=/var/run/build-farm/allocations
+: >"$ALLOCATION"
+
+JOBS_AMD64=${DISTCC_JOBS_AMD64:-$((TOTAL_JOBS * WEIGHT_AMD64 / TOTAL_WEIGHT))}
+if [ "$JOBS_AMD64" -lt 1 ]; then
+  JOBS_AMD64=1
+fi
+echo "amd64 3604 $JOBS_AMD64" >>"$ALLOCATION"
+
+JOBS_386=${DISTCC_JOBS_386:-$((TOTAL_JOBS * WEIGHT_386 / TOTAL_WEIGHT))}
+if [ "$JOBS_386" -lt 1 ]; then
+  JOBS_386=1
+fi
+echo "386 3603 $JOBS_386" >>"$ALLOCATION"
+
+JOBS_ARM32V5=${DISTCC_JOBS_ARM32V5:-$((TOTAL_JOBS * WEIGHT_ARM32V5 / TOTAL_WEIGHT))}
+if [ "$JOBS_ARM32V5" -lt 1 ]; then
+  JOBS_ARM32V5=1
+fi
+echo "arm/v5 3605 $JOBS_ARM32V5" >>"$ALLOCATION"
+
+JOBS_ARM32V7=${DISTCC_JOBS_ARM32V7:-$((TOTAL_JOBS * WEIGHT_ARM32V7 / TOTAL_WEIGHT))}
+if [ "$JOBS_ARM32V7" -lt 1 ]; then
+  JOBS_ARM32V7=1
+fi
+echo "arm/v7 3607 $JOBS_ARM32V7" >>"$ALLOCATION"
+
+JOBS_ARM64V8=${DISTCC_JOBS_ARM64V8:-$((TOTAL_JOBS * WEIGHT_ARM64V8 / TOTAL_WEIGHT))}
+if [ "$JOBS_ARM64V8" -lt 1 ]; then
+  JOBS_ARM64V8=1
+fi
+echo "arm64/v8 3608 $JOBS_ARM64V8" >>"$ALLOCATION"
+
+JOBS_PPC64LE=${DISTCC_JOBS_PPC64LE:-$((TOTAL_JOBS * WEIGHT_PPC64LE / TOTAL_WEIGHT))}
+if [ "$JOBS_PPC64LE" -lt 1 ]; then
+  JOBS_PPC64LE=1
+fi
+echo "ppc64le 3610 $JOBS_PPC64LE" >>"$ALLOCATION"
+
+JOBS_S390X=${DISTCC_JOBS_S390X:-$((TOTAL_JOBS * WEIGHT_S390X / TOTAL_WEIGHT))}
+if [ "$JOBS_S390X" -lt 1 ]; then
+  JOBS_S390X=1
+fi
+echo "s390x 3609 $JOBS_S390X" >>"$ALLOCATION"
+
+JOBS_MIPS64LE=${DISTCC_JOBS_MIPS64LE:-$((TOTAL_JOBS * WEIGHT_MIPS64LE / TOTAL_WEIGHT))}
+if [ "$JOBS_MIPS64LE" -lt 1 ]; then
+  JOBS_MIPS64LE=1
+fi
+echo "mips64le 3611 $JOBS_MIPS64LE" >>"$ALLOCATION"
+
+if [ -d "$SHARED_ALLOCATIONS" ]; then
+  cp "$ALLOCATION" "$SHARED_ALLOCATIONS/.host-386" &&
+    mv "$SHARED_ALLOCATIONS/.host-386" "$SHARED_ALLOCATIONS/host-386"
+fi
+echo "distccd job allocation for $TOTAL_JOBS slots ($CPUS CPUs, ${MEM_AVAILABLE_KB:-unknown} kB available):" >&2
+cat "$ALLOCATION" >&2
+
+
+export PATH="/usr/local/x86_64-linux-gnu/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3604 \
+  --jobs "$JOBS_AMD64" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-amd64.pid \
+  &
+
+export PATH="${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3603 \
+  --jobs "$JOBS_386" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-386.pid \
+  &
+
+export PATH="/usr/local/arm-linux-gnueabi/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3605 \
+  --jobs "$JOBS_ARM32V5" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-arm32v5.pid \
+  &
+
+export PATH="/usr/local/arm-linux-gnueabihf/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3607 \
+  --jobs "$JOBS_ARM32V7" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-arm32v7.pid \
+  &
+
+export PATH="/usr/local/aarch64-linux-gnu/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3608 \
+  --jobs "$JOBS_ARM64V8" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-arm64v8.pid \
+  &
+
+export PATH="/usr/local/powerpc64le-linux-gnu/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3610 \
+  --jobs "$JOBS_PPC64LE" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-ppc64le.pid \
+  &
+
+export PATH="/usr/local/s390x-linux-gnu/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3609 \
+  --jobs "$JOBS_S390X" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-s390x.pid \
+  &
+
+export PATH="/usr/local/mipsel-linux-gnu/bin:${ORIGINAL_PATH}"
+distccd \
+  --daemon \
+  --verbose \
+  --user distcc \
+  --no-detach \
+  --log-stderr \
+  --log-level info \
+  --allow 0.0.0.0/0 \
+  --listen 0.0.0.0 \
+  --port 3611 \
+  --jobs "$JOBS_MIPS64LE" \
+  --nice "$NICE" \
+  --pid-file /var/run/distccd/distccd-mips64le.pid \
+  &
+
+
+wait
\ No newline at end of file
@@ -15,9 +15,12 @@ main() {
   tar xzf cJSON-master.tar.gz -C /tmp/cJSON
   cd /tmp/cJSON/cJSON-master
 
-  # Compile cJSON
+  # Compile cJSON, preprocessing on the hosts if they are in pump mode
   make clean
-  make test
+  case "${DISTCC_HOSTS:-}" in
+    *,cpp*) pump make test ;;
+    *) make test ;;
+  esac
   cd ~
   rm -Rf /tmp/cJSON
 }
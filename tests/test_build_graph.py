@@ -0,0 +1,127 @@
+"""Tests of BuildGraph scheduling: dependency order, pool limits and the
+cancellation of a failed node's dependents."""
+
+import collections
+import threading
+import time
+
+import pytest
+
+import builder
+
+
+class Recorder:
+    """Node functions that record when they start and finish, and how many
+    nodes of each pool run at once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = collections.Counter()
+        self.max_running = collections.Counter()
+
+    def node(self, key, pool=None, seconds=0.01, error=None):
+        def func():
+            with self.lock:
+                self.events.append(("start", key))
+                self.running[pool] += 1
+                self.running["total"] += 1
+                for name in (pool, "total"):
+                    self.max_running[name] = max(self.max_running[name], self.running[name])
+            time.sleep(seconds)
+            with self.lock:
+                self.running[pool] -= 1
+                self.running["total"] -= 1
+                self.events.append(("finish", key))
+            if error is not None:
+                raise error
+
+        return func
+
+    def index(self, event, key):
+        return self.events.index((event, key))
+
+
+def test_dependencies_run_first():
+    recorder = Recorder()
+    graph = builder.BuildGraph()
+    graph.add(("host", "amd64"), recorder.node(("host", "amd64")))
+    graph.add(("host", "arm64/v8"), recorder.node(("host", "arm64/v8")))
+    graph.add(("client", "amd64"), recorder.node(("client", "amd64")), deps=[("host", "amd64")])
+    graph.add(
+        ("manifest",),
+        recorder.node(("manifest",)),
+        deps=[("host", "amd64"), ("host", "arm64/v8"), ("client", "amd64")],
+    )
+
+    status = graph.run(jobs=4)
+
+    assert status == {key: builder.BuildGraph.SUCCEEDED for key in graph.nodes}
+    for key, node in graph.nodes.items():
+        for dep in node.deps:
+            assert recorder.index("finish", dep) < recorder.index("start", key)
+
+
+def test_unknown_and_duplicate_nodes():
+    graph = builder.BuildGraph()
+    graph.add(("host", "amd64"), lambda: None)
+    with pytest.raises(ValueError, match="Duplicate"):
+        graph.add(("host", "amd64"), lambda: None)
+    with pytest.raises(ValueError, match="unknown node"):
+        graph.add(("client", "amd64"), lambda: None, deps=[("host", "arm64/v8")])
+
+
+def test_pool_limits():
+    recorder = Recorder()
+    graph = builder.BuildGraph()
+    for arch in ("arm/v5", "arm/v6", "arm/v7", "arm64/v8"):
+        graph.add(("host", arch), recorder.node(arch, pool="emulated", seconds=0.05), pool="emulated")
+    for arch in ("amd64", "386"):
+        graph.add(("host", arch), recorder.node(arch, pool="native", seconds=0.05), pool="native")
+
+    status = graph.run(jobs=4, pool_limits={"emulated": 1, "native": 2})
+
+    assert set(status.values()) == {builder.BuildGraph.SUCCEEDED}
+    assert recorder.max_running["emulated"] == 1
+    assert recorder.max_running["native"] == 2
+    # The native builds overlapped with the emulated ones
+    assert recorder.max_running["total"] == 3
+
+
+def test_pool_without_slots_raises():
+    graph = builder.BuildGraph()
+    graph.add(("host", "arm/v7"), lambda: None, pool="emulated")
+    with pytest.raises(RuntimeError, match="Cannot schedule"):
+        graph.run(jobs=2, pool_limits={"emulated": 0})
+
+
+def test_failure_cancels_only_dependents(capsys):
+    recorder = Recorder()
+    graph = builder.BuildGraph()
+    graph.add(("host", "amd64"), recorder.node("host amd64", error=RuntimeError("build failed")))
+    graph.add(("client", "amd64"), recorder.node("client amd64"), deps=[("host", "amd64")])
+    graph.add(("manifest", "client"), recorder.node("manifest client"), deps=[("client", "amd64")])
+    graph.add(("host", "arm64/v8"), recorder.node("host arm64/v8", seconds=0.05))
+    graph.add(("client", "arm64/v8"), recorder.node("client arm64/v8"), deps=[("host", "arm64/v8")])
+
+    status = graph.run(jobs=2)
+
+    assert status == {
+        ("host", "amd64"): builder.BuildGraph.FAILED,
+        ("client", "amd64"): builder.BuildGraph.CANCELLED,
+        ("manifest", "client"): builder.BuildGraph.CANCELLED,
+        ("host", "arm64/v8"): builder.BuildGraph.SUCCEEDED,
+        ("client", "arm64/v8"): builder.BuildGraph.SUCCEEDED,
+    }
+    assert ("start", "client amd64") not in recorder.events
+    assert ("start", "manifest client") not in recorder.events
+    out = capsys.readouterr()
+    assert "Failed host amd64: RuntimeError('build failed')" in out.err
+    assert "Cancelled manifest client (depends on client amd64)" in out.out
+
+
+def test_nodes_cannot_render(capsys):
+    graph = builder.BuildGraph()
+    graph.add(("render",), lambda: builder.Distro.render_many([builder.Distro.get("archlinux")]))
+    assert graph.run() == {("render",): builder.BuildGraph.FAILED}
+    assert "must be rendered before their build graph runs" in capsys.readouterr().err
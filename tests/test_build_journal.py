@@ -0,0 +1,155 @@
+"""Tests of the build journal, and of how build-all's --resume and --retry
+use it."""
+
+import types
+
+import pytest
+from path import (
+    Path,
+)
+
+import builder
+
+IMAGE = "elijahru/tmp:build-farm--amd64--test"
+
+
+def entry(**kwargs):
+    return dict(
+        dict(
+            run="run1",
+            distro="archlinux",
+            container_type="host",
+            arch="amd64",
+            image=IMAGE,
+            attempt=1,
+            status=builder.BuildJournal.SUCCEEDED,
+            inputs_digest="sha256:inputs1",
+            image_id="sha256:image1",
+            pushed=False,
+            started=0,
+            seconds=1,
+            error=None,
+        ),
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = builder.BuildJournal(Path(tmp_path) / "cache" / "build-journal.sqlite3")
+    monkeypatch.setattr(builder, "build_journal", journal)
+    return journal
+
+
+@pytest.fixture
+def inputs():
+    """The faked inputs digest and local images of the builds."""
+    return types.SimpleNamespace(digest="sha256:inputs1", local_images={IMAGE: {"Id": "sha256:image1"}})
+
+
+@pytest.fixture
+def distro(inputs, monkeypatch):
+    distro = builder.Distro.get("archlinux")
+    monkeypatch.setattr(distro, "build_inputs_digest", lambda *args, **kwargs: inputs.digest)
+    monkeypatch.setattr(builder, "local_image", inputs.local_images.get)
+    return distro
+
+
+class Build:
+    """A build function failing the given number of times first."""
+
+    def __init__(self, digest="sha256:inputs1", failures=0):
+        self.digest = digest
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError(f"failure {self.calls}")
+        return self.digest
+
+
+def build(distro, function, run="run2", **kwargs):
+    return distro.build_journaled("host", "amd64", IMAGE, function, run, **kwargs)
+
+
+def test_last_success(journal):
+    assert journal.last_success(IMAGE) is None
+    journal.record(**entry(run="run1"))
+    journal.record(**entry(run="run2", status=builder.BuildJournal.FAILED, error="RuntimeError()"))
+    journal.record(**entry(run="run3", image="elijahru/tmp:other"))
+
+    assert journal.last_success(IMAGE)["run"] == "run1"
+    journal.record(**entry(run="run4", attempt=0, status=builder.BuildJournal.RESUMED))
+    assert journal.last_success(IMAGE)["run"] == "run4"
+
+
+def test_query_filters(journal):
+    journal.record(**entry(run="run1"))
+    journal.record(**entry(run="run1", arch="arm/v7", status=builder.BuildJournal.FAILED))
+    journal.record(**entry(run="run2", arch="arm/v7"))
+
+    assert [row["run"] for row in journal.query(arch="arm/v7")] == ["run2", "run1"]
+    assert [row["arch"] for row in journal.query(status=builder.BuildJournal.FAILED)] == ["arm/v7"]
+    assert len(journal.query(limit=1)) == 1
+
+
+def test_resume_skips_unchanged_builds(journal, distro):
+    first = Build()
+    assert build(distro, first, run="run1", resume=True) == "sha256:inputs1"
+    assert first.calls == 1
+
+    second = Build()
+    assert build(distro, second, run="run2", resume=True) == "sha256:inputs1"
+    assert second.calls == 0
+    [resumed, built] = journal.query()
+    assert (resumed["run"], resumed["status"], resumed["attempt"]) == ("run2", builder.BuildJournal.RESUMED, 0)
+    assert resumed["image_id"] == built["image_id"] == "sha256:image1"
+
+
+def test_resume_rebuilds_changed_builds(journal, distro, inputs):
+    build(distro, Build(), run="run1")
+
+    # The inputs changed
+    inputs.digest = "sha256:inputs2"
+    changed = Build(digest="sha256:inputs2")
+    build(distro, changed, resume=True)
+    assert changed.calls == 1
+
+    # The local image is gone
+    inputs.local_images.clear()
+    missing = Build(digest="sha256:inputs2")
+    build(distro, missing, resume=True)
+    assert missing.calls == 1
+
+
+def test_resume_pushes_unpushed_builds(journal, distro):
+    build(distro, Build(), run="run1", push=False)
+    pushed = Build()
+    build(distro, pushed, push=True, resume=True)
+    assert pushed.calls == 1
+    assert journal.last_success(IMAGE)["pushed"]
+
+
+def test_resume_after_failure(journal, distro):
+    with pytest.raises(RuntimeError, match="failure 1"):
+        build(distro, Build(failures=1), run="run1")
+    retried = Build()
+    build(distro, retried, resume=True)
+    assert retried.calls == 1
+
+
+def test_retry(journal, distro, capsys):
+    flaky = Build(failures=2)
+    assert build(distro, flaky, retry=2, retry_delay=0) == "sha256:inputs1"
+    assert flaky.calls == 3
+    assert [(row["attempt"], row["status"]) for row in reversed(journal.query())] == [
+        (1, builder.BuildJournal.FAILED),
+        (2, builder.BuildJournal.FAILED),
+        (3, builder.BuildJournal.SUCCEEDED),
+    ]
+    assert f"Attempt 1 of {IMAGE} failed (RuntimeError('failure 1')), retrying in 0s" in capsys.readouterr().err
+
+    with pytest.raises(RuntimeError, match="failure 2"):
+        build(distro, Build(failures=2), retry=1, retry_delay=0)
@@ -0,0 +1,60 @@
+"""Tests of the clients' DISTCC_HOSTS from a farm inventory, and of parsing
+the job allocation written by the hosts' run.sh."""
+
+import pytest
+
+import builder
+
+INVENTORY = [
+    dict(address="build-host1", distro="alpine:3.15", arch="amd64", jobs=16, weights={"arm/v7": 4}),
+    dict(address="build-host2", distro="alpine:3.15", arch="arm64/v8", jobs=4),
+    dict(address="build-host3", distro="alpine:3.15", arch="arm64/v8"),
+    dict(address="build-host4", distro="archlinux", arch="amd64", jobs=32),
+]
+
+
+def test_hosts_limited_to_their_share_of_job_slots():
+    distcc_hosts = builder.Distro.get("alpine:3.15").distcc_hosts(INVENTORY)
+    # build-host1's 16 slots are split by weight: 4 for arm/v7, 1 for each of
+    # its 5 other compiler archs
+    assert distcc_hosts["arm/v7"] == "build-host1:3807/7"
+    assert distcc_hosts["amd64"] == "build-host1:3804/1"
+    assert set(distcc_hosts) == {"386", "amd64", "arm/v6", "arm/v7", "arm64/v8", "ppc64le"}
+
+
+def test_roomiest_hosts_first():
+    distcc_hosts = builder.Distro.get("alpine:3.15").distcc_hosts(INVENTORY)
+    # build-host3 has no known job slots, so distcc's default limit of 4 ranks it
+    # with build-host2, in inventory order
+    assert distcc_hosts["arm64/v8"] == "build-host2:3808/4 build-host3:3808 build-host1:3808/1"
+
+
+def test_limit_is_at_least_one():
+    inventory = [dict(address="small", distro="alpine:3.15", arch="amd64", jobs=2)]
+    distcc_hosts = builder.Distro.get("alpine:3.15").distcc_hosts(inventory)
+    assert set(distcc_hosts.values()) == {
+        f"small:{port}/1" for port in ("3803", "3804", "3806", "3807", "3808", "3810")
+    }
+
+
+def test_pump_options():
+    distcc_hosts = builder.Distro.get("alpine:3.15").distcc_hosts(INVENTORY, pump=True)
+    assert distcc_hosts["arm64/v8"] == "build-host2:3808/4,cpp,lzo build-host3:3808,cpp,lzo build-host1:3808/1,cpp,lzo"
+
+
+def test_only_hosts_of_the_distro():
+    distcc_hosts = builder.Distro.get("archlinux").distcc_hosts(INVENTORY)
+    assert distcc_hosts["amd64"] == "build-host4:3704/6"
+    assert builder.Distro.get("debian:buster").distcc_hosts(INVENTORY) == {}
+
+
+def test_unsupported_host_arch():
+    inventory = [dict(address="build-host5", distro="archlinux", arch="ppc64le")]
+    with pytest.raises(ValueError, match="archlinux has no linux/ppc64le host, inventory host build-host5"):
+        builder.Distro.get("archlinux").distcc_hosts(inventory)
+
+
+def test_parse_job_allocation():
+    allocation = builder.parse_job_allocation("amd64 3804 8\narm/v7 3807 4\n\nmalformed line\n386 3803 1\n")
+    assert allocation == {"amd64": 8, "arm/v7": 4, "386": 1}
+    assert builder.parse_job_allocation("") == {}
@@ -0,0 +1,191 @@
+"""Tests of DockerClient against a stand-in Docker Engine API served on a unix
+socket, and of the docker CLI fallback."""
+
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+
+import pytest
+
+import builder
+
+
+class EngineHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+        # A route's response is (status, chunks), sent chunked if there are several
+        status, chunks = self.server.routes.get(
+            (self.command, self.path.split("?")[0]),
+            (404, [b'{"message": "page not found"}']),
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if len(chunks) == 1:
+            self.send_header("Content-Length", str(len(chunks[0])))
+            self.end_headers()
+            self.wfile.write(chunks[0])
+        else:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+    do_GET = do_POST = do_HEAD = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EngineServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def engine():
+    # Unix socket paths are limited to ~100 bytes, too few for tmp_path
+    socket_dir = tempfile.mkdtemp()
+    server = EngineServer(os.path.join(socket_dir, "docker.sock"), EngineHandler)
+    server.routes = {("GET", "/_ping"): (200, [b"OK"])}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(socket_dir)
+
+
+@pytest.fixture
+def client(engine, tmp_path):
+    return builder.DockerClient(host=f"unix://{engine.server_address}", config_dir=str(tmp_path))
+
+
+@pytest.fixture
+def docker_cli(monkeypatch):
+    """Record the docker CLI calls, answering them from a dict of outputs."""
+    calls = []
+    outputs = {}
+
+    def docker(*args, **kwargs):
+        calls.append(args)
+        return outputs.get(args[:2], "")
+
+    monkeypatch.setattr(builder, "docker", docker)
+    return calls, outputs
+
+
+def test_available_pings_the_daemon(engine, client):
+    assert client.available()
+    assert [(method, path) for method, path, _, _ in engine.requests] == [("GET", "/_ping")]
+
+
+def test_unavailable_without_socket(tmp_path):
+    assert not builder.DockerClient(host=f"unix://{tmp_path}/missing.sock").available()
+    assert not builder.DockerClient(host="tcp://127.0.0.1:2375").available()
+
+
+def test_call_decodes_json_and_reuses_connections(engine, client):
+    engine.routes[("GET", "/images/json")] = (
+        200,
+        [json.dumps([{"RepoTags": ["alpine:3.15", "debian:buster"]}, {"RepoTags": None}]).encode()],
+    )
+    assert client.image_repo_tags() == ["alpine:3.15", "debian:buster"]
+    assert client.image_repo_tags() == ["alpine:3.15", "debian:buster"]
+    assert len(client.idle) == 1
+
+
+def test_chunked_stream_split_mid_object(engine, client):
+    engine.routes[("POST", "/images/create")] = (
+        200,
+        [
+            b'{"status": "Pulling fr',
+            b'om library/alpine"}\r\n{"status": "Downloading", "progressDetail": {"current": 1}, "id": "abc"}',
+            b'\r\n{"status": "Done"}\r\n',
+        ],
+    )
+    messages = list(client.stream("POST", "/images/create"))
+    assert [message["status"] for message in messages] == ["Pulling from library/alpine", "Downloading", "Done"]
+
+
+def test_chunked_stream_split_mid_character(engine, client):
+    message = '{"error": "Ungültiges Manifest"}'.encode()
+    split = message.index("ü".encode()) + 1
+    engine.routes[("POST", "/images/create")] = (200, [b'{"status": "Pulling"}\r\n' + message[:split], message[split:]])
+    with pytest.raises(builder.DockerAPIError, match="Ungültiges Manifest"):
+        client.pull("alpine:3.15")
+
+
+def test_pull_params_and_registry_auth(engine, client):
+    engine.routes[("POST", "/images/create")] = (200, [b'{"status": "Done"}'])
+    client.pull("alpine:3.15", platform="linux/arm64/v8")
+    method, path, headers, _ = engine.requests[-1]
+    assert (method, path) == ("POST", "/images/create?fromImage=alpine&tag=3.15&platform=linux%2Farm64%2Fv8")
+    # Anonymous, as the config has no credentials
+    assert headers["X-Registry-Auth"] == "e30="
+
+
+def test_error_status_raises_json_message(engine, client):
+    engine.routes[("GET", "/images/missing/json")] = (404, [b'{"message": "No such image: missing"}'])
+    with pytest.raises(builder.DockerAPIError, match="404 No such image: missing"):
+        client.inspect_image("missing")
+    # The connection is still usable after an error
+    engine.routes[("GET", "/images/alpine/json")] = (200, [b'{"Id": "sha256:abc"}'])
+    assert client.inspect_image("alpine") == {"Id": "sha256:abc"}
+    assert len(client.idle) == 1
+
+
+def test_error_status_raises_plain_message(engine, client):
+    engine.routes[("POST", "/containers/abc/kill")] = (500, [b"daemon exploded\n"])
+    with pytest.raises(builder.DockerAPIError, match="500 daemon exploded"):
+        client.kill("abc")
+
+
+def test_stream_error_message_raises(engine, client):
+    engine.routes[("POST", "/images/create")] = (
+        200,
+        [b'{"status": "Pulling"}\r\n', b'{"error": "manifest unknown"}\r\n'],
+    )
+    with pytest.raises(builder.DockerAPIError, match="manifest unknown"):
+        client.pull("alpine:3.15")
+
+
+def test_truncated_stream_raises(engine, client):
+    engine.routes[("POST", "/images/create")] = (200, [b'{"status": "Pulling"}', b'{"status": "Pul'])
+    with pytest.raises(builder.DockerAPIError, match="Truncated"):
+        client.pull("alpine:3.15")
+
+
+def test_cli_fallback_without_daemon(monkeypatch, tmp_path, docker_cli):
+    calls, outputs = docker_cli
+    monkeypatch.setattr(builder, "docker_api", builder.DockerClient(host=f"unix://{tmp_path}/missing.sock"))
+    outputs[("image", "inspect")] = '[{"Id": "sha256:abc"}]'
+
+    builder.docker_pull("alpine:3.15", platform="linux/arm64/v8")
+    assert builder.local_image("alpine:3.15") == {"Id": "sha256:abc"}
+    assert calls[0] == ("pull", "alpine:3.15", "--platform", "linux/arm64/v8")
+    assert calls[1][:3] == ("image", "inspect", "alpine:3.15")
+
+
+def test_cli_fallback_for_credential_helpers(engine, monkeypatch, tmp_path, docker_cli):
+    calls, _ = docker_cli
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({"credsStore": "desktop"}, f)
+    monkeypatch.setattr(
+        builder,
+        "docker_api",
+        builder.DockerClient(host=f"unix://{engine.server_address}", config_dir=str(tmp_path)),
+    )
+
+    builder.docker_push("elijahru/tmp:test")
+    assert calls == [("push", "elijahru/tmp:test")]
+    assert not [path for method, path, _, _ in engine.requests if method == "POST"]
@@ -0,0 +1,114 @@
+"""Tests of the Prefetcher's decisions of what to pull, with the docker CLI
+and registry lookups faked."""
+
+import pytest
+from path import (
+    Path,
+)
+
+import builder
+
+IMAGE = "elijahru/tmp:build-farm--amd64--test"
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    """Fake local images, keyed by tag, and the pulls of the prefetcher."""
+    local_images = {}
+    pulls = []
+    monkeypatch.setattr(builder, "local_image", local_images.get)
+    monkeypatch.setattr(builder, "docker_pull", lambda image, platform=None: pulls.append((image, platform)))
+    monkeypatch.setattr(builder, "is_image_current", lambda local, image, platform: local.get("Current", False))
+    monkeypatch.setattr(builder, "build_index", builder.BuildIndex(Path(tmp_path) / "build-index.json"))
+    return local_images, pulls
+
+
+@pytest.fixture
+def prefetcher():
+    prefetcher = builder.Prefetcher(2)
+    yield prefetcher
+    prefetcher.close()
+
+
+def built_image(digest, **kwargs):
+    return dict(Config=dict(Labels={builder.INPUTS_DIGEST_LABEL: digest}), **kwargs)
+
+
+def test_missing_image_is_pulled(images, prefetcher):
+    _, pulls = images
+    prefetcher.schedule(IMAGE, "linux/amd64")
+    assert prefetcher.wait(IMAGE, "linux/amd64")
+    assert pulls == [(IMAGE, "linux/amd64")]
+
+
+def test_unpushed_local_build_is_not_pulled(images, prefetcher, capsys):
+    local_images, pulls = images
+    local_images[IMAGE] = built_image("sha256:inputs1")
+    builder.build_index.record(IMAGE, "sha256:inputs1", pushed=False)
+
+    prefetcher.schedule(IMAGE, "linux/amd64")
+    # Not pulled, nor the registry copy
+    assert not prefetcher.wait(IMAGE, "linux/amd64")
+    assert pulls == []
+    assert f"Not prefetching {IMAGE}, the local build has not been pushed yet" in capsys.readouterr().out
+
+
+def test_pushed_local_build_is_pulled(images, prefetcher):
+    local_images, pulls = images
+    local_images[IMAGE] = built_image("sha256:inputs1")
+    builder.build_index.record(IMAGE, "sha256:inputs1", pushed=True)
+
+    assert prefetcher.wait(IMAGE, "linux/amd64")
+    assert pulls == [(IMAGE, "linux/amd64")]
+
+
+def test_older_local_build_is_pulled(images, prefetcher):
+    local_images, pulls = images
+    local_images[IMAGE] = built_image("sha256:inputs0")
+    builder.build_index.record(IMAGE, "sha256:inputs1", pushed=False)
+
+    assert prefetcher.wait(IMAGE, "linux/amd64")
+    assert pulls == [(IMAGE, "linux/amd64")]
+
+
+def test_current_image_is_not_pulled(images, prefetcher):
+    local_images, pulls = images
+    local_images["archlinux"] = dict(Current=True)
+    assert prefetcher.wait("archlinux", "linux/amd64")
+    assert pulls == []
+
+
+def test_failed_prefetch_is_a_miss(images, prefetcher, monkeypatch, capsys):
+    def docker_pull(image, platform=None):
+        raise builder.DockerAPIError("500 daemon exploded")
+
+    monkeypatch.setattr(builder, "docker_pull", docker_pull)
+    assert not prefetcher.wait(IMAGE, "linux/amd64")
+    assert f"Could not prefetch {IMAGE} (linux/amd64)" in capsys.readouterr().out
+
+
+def test_base_image_prefetched_for_one_platform(images, prefetcher):
+    _, pulls = images
+    prefetcher.schedule("archlinux", "linux/amd64", base=True)
+    prefetcher.schedule("archlinux", "linux/arm64/v8", base=True)
+    assert prefetcher.base_key("archlinux") == ("archlinux", "linux/amd64")
+    assert prefetcher.base_key("debian:buster") is None
+
+    assert prefetcher.wait(*prefetcher.base_key("archlinux"))
+    assert pulls == [("archlinux", "linux/amd64")]
+
+
+def test_prefetch_depth(images):
+    _, pulls = images
+    prefetcher = builder.Prefetcher(1)
+    try:
+        for arch in ("amd64", "arm64/v8", "arm/v7"):
+            prefetcher.schedule(f"elijahru/tmp:{builder.arch_slug(arch)}", f"linux/{arch}")
+        prefetcher.wait("elijahru/tmp:amd64", "linux/amd64")
+        # One image ahead of the build that reached amd64
+        assert set(prefetcher.futures) == {
+            ("elijahru/tmp:amd64", "linux/amd64"),
+            ("elijahru/tmp:arm64v8", "linux/arm64/v8"),
+        }
+    finally:
+        prefetcher.close()
@@ -0,0 +1,241 @@
+"""Tests of RegistryClient against a stand-in registry v2 API with bearer token
+auth, and of the `docker manifest` fallback of Distro.push_manifest."""
+
+import base64
+import hashlib
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+
+import pytest
+
+import builder
+
+MANIFEST_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+
+def digest_of(content):
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+class RegistryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, content=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def respond(self):
+        registry = self.server.registry
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        registry.requests.append((self.command, self.path))
+
+        if url.path == "/token":
+            registry.token_requests.append((query, self.headers.get("Authorization")))
+            return self.send(200, json.dumps({"token": "good-token"}).encode())
+
+        if registry.auth and self.headers.get("Authorization") != "Bearer good-token":
+            challenge = f'Bearer realm="http://{registry.address}/token",service="stub-registry"'
+            return self.send(401, b'{"errors": [{"code": "UNAUTHORIZED"}]}', {"WWW-Authenticate": challenge})
+
+        match = re.match(r"^/v2/(.+)/manifests/([^/]+)$", url.path)
+        if match:
+            repository, reference = match.groups()
+            if self.command == "PUT":
+                digest = digest_of(body)
+                registry.manifests[(repository, digest)] = (self.headers["Content-Type"], body)
+                registry.manifests[(repository, reference)] = (self.headers["Content-Type"], body)
+                return self.send(201, headers={"Docker-Content-Digest": digest})
+            if (repository, reference) not in registry.manifests:
+                return self.send(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+            media_type, content = registry.manifests[(repository, reference)]
+            return self.send(200, content, {"Content-Type": media_type, "Docker-Content-Digest": digest_of(content)})
+
+        match = re.match(r"^/v2/(.+)/blobs/uploads/(.*)$", url.path)
+        if match:
+            repository, upload = match.groups()
+            if self.command == "DELETE":
+                return self.send(204)
+            digest, from_repository = query["mount"][0], query["from"][0]
+            if registry.mount and digest in registry.blobs.get(from_repository, ()):
+                registry.blobs.setdefault(repository, set()).add(digest)
+                return self.send(201, headers={"Docker-Content-Digest": digest})
+            return self.send(202, headers={"Location": f"/v2/{repository}/blobs/uploads/upload-1"})
+
+        self.send(404)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubRegistry:
+    def __init__(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RegistryHandler)
+        self.server.daemon_threads = True
+        self.server.registry = self
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+        self.manifests = {}
+        self.blobs = {}
+        self.requests = []
+        self.token_requests = []
+        self.auth = True
+        self.mount = True
+
+    def add_image(self, repository, tag, arch):
+        """Store a single platform image, returning its manifest."""
+        config = digest_of(f"config {repository} {arch}".encode())
+        layer = digest_of(f"layer {repository} {arch}".encode())
+        self.blobs.setdefault(repository, set()).update((config, layer))
+        content = json.dumps(
+            dict(
+                schemaVersion=2,
+                mediaType=MANIFEST_TYPE,
+                config=dict(mediaType="application/vnd.docker.container.image.v1+json", size=1, digest=config),
+                layers=[dict(mediaType="application/vnd.docker.image.rootfs.diff.tar.gzip", size=1, digest=layer)],
+            )
+        ).encode()
+        self.manifests[(repository, tag)] = (MANIFEST_TYPE, content)
+        self.manifests[(repository, digest_of(content))] = (MANIFEST_TYPE, content)
+        return content
+
+    def add_manifest_list(self, repository, tag, archs):
+        content = json.dumps(
+            dict(
+                schemaVersion=2,
+                mediaType=builder.MANIFEST_LIST_TYPE,
+                manifests=[
+                    dict(
+                        mediaType=MANIFEST_TYPE,
+                        digest=digest_of(manifest),
+                        size=len(manifest),
+                        platform=builder.manifest_platform(arch),
+                    )
+                    for arch in archs
+                    for manifest in (self.add_image(repository, f"{tag}-{builder.arch_slug(arch)}", arch),)
+                ],
+            )
+        ).encode()
+        self.manifests[(repository, tag)] = (builder.MANIFEST_LIST_TYPE, content)
+
+
+@pytest.fixture
+def registry():
+    registry = StubRegistry()
+    thread = threading.Thread(target=registry.server.serve_forever, daemon=True)
+    thread.start()
+    yield registry
+    registry.server.shutdown()
+    registry.server.server_close()
+
+
+@pytest.fixture
+def client(tmp_path):
+    return builder.RegistryClient(config_dir=str(tmp_path))
+
+
+def test_bearer_token_flow(registry, client, tmp_path):
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({"auths": {registry.address: {"auth": base64.b64encode(b"user:secret").decode()}}}, f)
+    manifest = registry.add_image("tmp", "host-amd64", "amd64")
+
+    image = f"{registry.address}/tmp:host-amd64"
+    assert client.manifest_digest(image) == digest_of(manifest)
+    assert client.manifest_digest(image) == digest_of(manifest)
+
+    # The token is fetched once per scope, with the config's credentials
+    [(query, authorization)] = registry.token_requests
+    assert query == {"service": ["stub-registry"], "scope": ["repository:tmp:pull"]}
+    assert authorization == "Basic " + base64.b64encode(b"user:secret").decode()
+
+
+def test_get_platform_manifest_from_manifest_list(registry, client):
+    registry.add_manifest_list("library/base", "latest", ["amd64", "arm/v7", "arm64/v8"])
+    media_type, digest, content = client.get_platform_manifest(f"{registry.address}/library/base:latest", "arm/v7")
+    assert media_type == MANIFEST_TYPE
+    assert content == registry.manifests[("library/base", "latest-arm32v7")][1]
+    assert digest == digest_of(content)
+
+    with pytest.raises(builder.RegistryError, match="no linux/s390x manifest"):
+        client.get_platform_manifest(f"{registry.address}/library/base:latest", "s390x")
+
+
+def test_push_manifest_list_mounts_blobs(registry, client):
+    amd64 = registry.add_image("tmp", "build-farm--amd64--1.0", "amd64")
+    armv7 = registry.add_image("tmp", "build-farm--arm32v7--1.0", "arm/v7")
+    images = {
+        "amd64": f"{registry.address}/tmp:build-farm--amd64--1.0",
+        "arm/v7": f"{registry.address}/tmp:build-farm--arm32v7--1.0",
+    }
+    manifest_tags = (
+        f"{registry.address}/build-farm:debian-buster--1.0",
+        f"{registry.address}/build-farm:debian-buster",
+    )
+
+    client.push_manifest_list(manifest_tags, images)
+
+    # The images' blobs were mounted from tmp, and their manifests pushed by digest
+    assert registry.blobs["build-farm"] == registry.blobs["tmp"]
+    for manifest in (amd64, armv7):
+        assert registry.manifests[("build-farm", digest_of(manifest))] == (MANIFEST_TYPE, manifest)
+
+    for reference in ("debian-buster--1.0", "debian-buster"):
+        media_type, content = registry.manifests[("build-farm", reference)]
+        assert media_type == builder.MANIFEST_LIST_TYPE
+        manifest_list = json.loads(content)
+        assert manifest_list["mediaType"] == builder.MANIFEST_LIST_TYPE
+        assert [(entry["digest"], entry["size"], entry["platform"]) for entry in manifest_list["manifests"]] == [
+            (digest_of(amd64), len(amd64), {"os": "linux", "architecture": "amd64"}),
+            (digest_of(armv7), len(armv7), {"os": "linux", "architecture": "arm", "variant": "v7"}),
+        ]
+
+
+def test_mount_not_supported_cancels_upload(registry, client):
+    registry.mount = False
+    manifest = json.loads(registry.add_image("tmp", "build-farm--amd64--1.0", "amd64"))
+
+    with pytest.raises(builder.RegistryError, match="Could not mount"):
+        client.mount_blob(registry.address, "build-farm", manifest["config"]["digest"], "tmp")
+    # The upload the registry started instead is cancelled
+    assert ("DELETE", "/v2/build-farm/blobs/uploads/upload-1") in registry.requests
+
+
+def test_push_manifest_falls_back_to_docker_manifest(registry, client, monkeypatch):
+    registry.mount = False
+    registry.add_image("tmp", "build-farm--amd64--1.0", "amd64")
+    registry.add_image("tmp", "build-farm--arm32v7--1.0", "arm/v7")
+    images = {
+        "amd64": f"{registry.address}/tmp:build-farm--amd64--1.0",
+        "arm/v7": f"{registry.address}/tmp:build-farm--arm32v7--1.0",
+    }
+    manifest = f"{registry.address}/build-farm:debian-buster"
+
+    calls = []
+    monkeypatch.setattr(builder, "registry_client", client)
+    monkeypatch.setattr(builder, "docker", lambda *args, **kwargs: calls.append(args))
+    monkeypatch.setattr(builder, "docker_pull", lambda image, platform=None: calls.append(("pull", image)))
+    # push_manifest enables the experimental CLI, restore it afterwards
+    monkeypatch.setenv("DOCKER_CLI_EXPERIMENTAL", "")
+
+    builder.Distro.get("debian:buster").push_manifest((manifest,), images)
+
+    assert calls == [
+        ("pull", images["amd64"]),
+        ("pull", images["arm/v7"]),
+        ("manifest", "create", "--amend", manifest, images["amd64"], images["arm/v7"]),
+        ("manifest", "annotate", manifest, images["amd64"], "--os", "linux", "--arch", "amd64"),
+        ("manifest", "annotate", manifest, images["arm/v7"], "--os", "linux", "--arch", "arm", "--variant", "v7"),
+        ("manifest", "push", manifest),
+    ]
+    assert ("build-farm", "debian-buster") not in registry.manifests
@@ -0,0 +1,159 @@
+"""Tests of incremental rendering against a copy of the templates: the render
+manifest, removal of stale outputs and no-op re-renders."""
+
+import json
+import os
+import shutil
+
+import pytest
+from path import (
+    Path,
+)
+from ruamel import (
+    yaml,
+)
+
+import builder
+
+INVENTORY = [dict(address="build-host1", distro="archlinux", arch="amd64", jobs=8)]
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """A project dir holding a copy of archlinux's templates."""
+    project_dir = Path(tmp_path) / "project"
+    for path in ("archlinux-like", "shared-build-context"):
+        shutil.copytree(builder.PROJECT_DIR / path, project_dir / path)
+    os.makedirs(project_dir / ".github/workflows")
+    shutil.copy(builder.PROJECT_DIR / ".github/workflows/build.yml.jinja", project_dir / ".github/workflows")
+    monkeypatch.setattr(builder, "PROJECT_DIR", project_dir)
+    monkeypatch.setattr(builder, "CACHE_DIR", Path(tmp_path) / "cache")
+    # The template environment loads from PROJECT_DIR
+    builder.get_template_env.cache_clear()
+    distro = builder.Distro.get("archlinux")
+    monkeypatch.setattr(distro, "_rendered_key", None)
+    yield project_dir
+    builder.get_template_env.cache_clear()
+
+
+def render(distro, **context):
+    # Bypass the memoized render key, so every render is written out
+    distro._rendered_key = None
+    distro.render(version="test", **context)
+
+
+def mtimes(project_dir, paths):
+    return {path: os.stat(project_dir / path).st_mtime_ns for path in paths}
+
+
+def test_manifest_lists_outputs(project):
+    distro = builder.Distro.get("archlinux")
+    render(distro)
+
+    manifest = distro.load_render_manifest()
+    assert manifest["archlinux/host/Dockerfile.amd64"]["source"] == "archlinux-like/host/Dockerfile.jinja"
+    assert (
+        manifest["archlinux/host/build-context/scripts/setup.sh"]["source"]
+        == "archlinux-like/host/build-context/scripts/setup.sh"
+    )
+    assert ".github/workflows/archlinux.yml" in manifest
+    for out_path, entry in manifest.items():
+        assert builder.file_digest(project / out_path) == entry["digest"]
+
+
+def test_rerender_is_a_no_op(project, capsys):
+    distro = builder.Distro.get("archlinux")
+    render(distro)
+    manifest = distro.load_render_manifest()
+    before = mtimes(project, [*manifest, distro.render_manifest_path])
+    capsys.readouterr()
+
+    render(distro)
+
+    assert distro.load_render_manifest() == manifest
+    assert mtimes(project, [*manifest, distro.render_manifest_path]) == before
+    assert f"Rendered archlinux: 0 added, 0 changed, 0 removed, {len(manifest)} unchanged" in capsys.readouterr().out
+
+
+def test_memoized_render_is_skipped(project, capsys):
+    distro = builder.Distro.get("archlinux")
+    distro.render(version="test")
+    capsys.readouterr()
+    distro.render(version="test")
+    assert "archlinux is up to date, not re-rendering" in capsys.readouterr().out
+
+
+def test_stale_outputs_are_removed(project, capsys):
+    distro = builder.Distro.get("archlinux")
+    render(distro, inventory=INVENTORY)
+    env_paths = [str(distro.distcc_hosts_env_path(arch)) for arch in distro.compiler_archs_by_host_arch["amd64"]]
+    for path in env_paths:
+        assert os.path.exists(project / path)
+    capsys.readouterr()
+
+    # Without an inventory, the distcc hosts env files are no longer produced
+    render(distro)
+
+    manifest = distro.load_render_manifest()
+    for path in env_paths:
+        assert not os.path.exists(project / path)
+        assert path not in manifest
+    assert f"{len(env_paths)} removed" in capsys.readouterr().out
+
+
+def test_changed_output_is_rewritten(project, capsys):
+    distro = builder.Distro.get("archlinux")
+    render(distro)
+    with open(project / "archlinux/docker-compose.yml", "a") as f:
+        f.write("# edited\n")
+    capsys.readouterr()
+
+    render(distro)
+
+    with open(project / "archlinux/docker-compose.yml") as f:
+        assert "# edited" not in f.read()
+    assert "0 added, 1 changed, 0 removed" in capsys.readouterr().out
+
+
+def test_streamed_build_contexts_remove_copies(project):
+    distro = builder.Distro.get("archlinux")
+    render(distro)
+    copied = [str(dst) for _, dst in distro.copied_files()]
+
+    render(distro, copy_build_contexts=False)
+
+    manifest = distro.load_render_manifest()
+    for path in copied:
+        assert not os.path.exists(project / path)
+        assert path not in manifest
+    # Rendered files of the build context are still written
+    assert os.path.exists(project / "archlinux/host/build-context/scripts/run-amd64.sh")
+    with open(project / distro.render_manifest_path) as f:
+        assert json.load(f) == manifest
+
+
+def test_compose_shares_job_allocations(project):
+    distro = builder.Distro.get("archlinux")
+    render(distro)
+    with open(project / distro.docker_compose_yml_path) as f:
+        compose = yaml.load(f, Loader=yaml.SafeLoader)
+
+    mount = "build-farm-allocation-archlinux:/var/run/build-farm/allocations"
+    for name, service in compose["services"].items():
+        assert (mount if name.startswith("host-") else f"{mount}:ro") in service["volumes"]
+    assert compose["volumes"] == {"build-farm-allocation-archlinux": {"name": "build-farm-allocation-archlinux"}}
+
+
+def test_render_workers_report_spans(project, monkeypatch):
+    monkeypatch.setattr(builder, "tracer", builder.Tracer())
+    distro = builder.Distro.get("archlinux")
+    distro._rendered_key = None
+    distro.render(jobs=2, version="test")
+
+    [render_span] = [event for event in builder.tracer.events if event["name"] == "render"]
+    template_spans = [event for event in builder.tracer.events if event["name"] == "render.template"]
+    # Every template was rendered by a worker process, within the parent's span
+    assert len(template_spans) == len(distro.load_render_manifest()) - len(distro.copied_files())
+    assert os.getpid() not in {event["pid"] for event in template_spans}
+    for event in template_spans:
+        assert render_span["ts"] <= event["ts"] <= event["ts"] + event["dur"] <= render_span["ts"] + render_span["dur"]